@@ -0,0 +1,52 @@
+# Awaitable versions of the queries in queries.py.
+# Each one runs on one of the database's own threads, so a slow query doesn't block the event loop.
+from functools import wraps
+import queries as q
+import metrics
+
+
+def _on_db_thread(f):
+    @metrics.timed(metrics.QUERIES)
+    @wraps(f)
+    async def inner(db, *args, **kwargs):
+        return await db.run(f, *args, **kwargs)
+    return inner
+
+def _on_reader_thread(f):
+    # Only for queries that use db.read(), so they can run alongside writes
+    @metrics.timed(metrics.QUERIES)
+    @wraps(f)
+    async def inner(db, *args, **kwargs):
+        return await db.run_read(f, *args, **kwargs)
+    return inner
+
+#
+# SCENE
+#
+
+get_open_channel = _on_db_thread(q.get_open_channel)
+list_free_channels = _on_reader_thread(q.list_free_channels)
+get_channel_info = _on_reader_thread(q.get_channel_info)
+add_new_channel = _on_db_thread(q.add_new_channel)
+reserve_channel = _on_db_thread(q.reserve_channel)
+free_channel = _on_db_thread(q.free_channel)
+touch_channels = _on_db_thread(q.touch_channels)
+list_idle_scenes = _on_reader_thread(q.list_idle_scenes)
+count_channels = _on_reader_thread(q.count_channels)
+list_channels = _on_reader_thread(q.list_channels)
+
+#
+# LEADERBOARD
+#
+
+record_messages = _on_db_thread(q.record_messages)
+record_message = _on_db_thread(q.record_message)
+count_messages = _on_reader_thread(q.count_messages)
+delete_messages = _on_db_thread(q.delete_messages)
+delete_message = _on_db_thread(q.delete_message)
+get_backfill_progress = _on_reader_thread(q.get_backfill_progress)
+save_backfill = _on_db_thread(q.save_backfill)
+clear_backfill_progress = _on_db_thread(q.clear_backfill_progress)
+oldest_uncompacted_day = _on_db_thread(q.oldest_uncompacted_day)
+compact_day = _on_db_thread(q.compact_day)
+vacuum_step = _on_db_thread(q.vacuum_step)
@@ -0,0 +1,149 @@
+# Benchmarks for queries.py against databases filled with synthetic data.
+# Everything runs offline against temporary database files, and the results are printed as JSON.
+#   python bench.py --sizes 10000 100000 1000000 --output results.json
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import db
+import queries as q
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000, 10_000_000]
+DISCORD_EPOCH = 1420070400000
+# Synthetic messages are spread over this many days before now
+SPAN_DAYS = 365
+# Rows are inserted this many at a time while filling
+FILL_CHUNK = 100_000
+
+
+def snowflake(seconds: int, sequence: int) -> int:
+    '''Make a discord-style id for something created at the given epoch time'''
+    return ((seconds * 1000 - DISCORD_EPOCH) << 22) | (sequence % (1 << 22))
+
+
+def fill_leaderboard(database: db.Database, messages: int, authors: int, channels: int, now: int):
+    '''Insert synthetic messages directly, then build message_counts from them in one go'''
+    start = now - SPAN_DAYS * 86400
+    c = database.get()
+    for offset in range(0, messages, FILL_CHUNK):
+        rows = []
+        for i in range(offset, min(offset + FILL_CHUNK, messages)):
+            date = random.randint(start, now - 1)
+            rows.append((random.randrange(authors), date, random.randrange(channels), snowflake(date, i)))
+        c.executemany("INSERT OR IGNORE INTO messages(author, date, channel_id, message_id) VALUES(?, ?, ?, ?);", rows)
+    c.execute("INSERT INTO message_counts(hour, author, count) SELECT date / 3600, author, COUNT(*) FROM messages GROUP BY 1, 2;")
+    database.commit()
+
+
+def fill_scene(database: db.Database, channels: int, free: int):
+    '''Register channels, all in use except for the last few'''
+    c = database.get()
+    c.executemany("INSERT INTO channels(id) VALUES(?)", [(i,) for i in range(channels)])
+    c.executemany("INSERT INTO channel_scenes(id, channel_name, created_by, created, updated, scene_name) VALUES(?, ?, ?, ?, ?, ?)",
+        [(i, f"rp-{i + 1}", 1, "2020-01-01 00:00:00", "2020-01-01 00:00:00", "scene")
+            for i in range(channels - free)])
+    c.executemany("INSERT INTO channel_scenes(id, channel_name) VALUES(?, ?)",
+        [(i, f"rp-{i + 1}") for i in range(channels - free, channels)])
+    database.commit()
+
+
+def time_calls(f, runs: int):
+    '''Call f runs times and summarize how long each call took, in milliseconds'''
+    times = []
+    for i in range(runs):
+        start = time.perf_counter()
+        f(i)
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return {
+        "runs": runs,
+        "mean_ms": statistics.mean(times),
+        "median_ms": statistics.median(times),
+        "p95_ms": times[min(runs - 1, int(runs * 0.95))],
+        "max_ms": times[-1],
+    }
+
+
+def file_size(database: db.Database) -> int:
+    # In WAL mode new rows sit in the -wal file until a checkpoint copies them into the database
+    database.get().execute("PRAGMA wal_checkpoint(TRUNCATE);")
+    return os.path.getsize(database.path())
+
+
+def bench_size(messages: int, authors: int, channels: int, runs: int):
+    now_dt = datetime.utcnow().replace(microsecond=0)
+    now = q.as_epoch(now_dt)
+    result = {"messages": messages, "authors": authors, "channels": channels}
+
+    leaderboard = db.Database("leaderboard", messages)
+    start = time.perf_counter()
+    fill_leaderboard(leaderboard, messages, authors, channels, now)
+    result["fill_seconds"] = time.perf_counter() - start
+    result["leaderboard_bytes"] = file_size(leaderboard)
+
+    scene = db.Database("scene", messages)
+    fill_scene(scene, channels, free=1)
+
+    def record(i):
+        author = SimpleNamespace(id=random.randrange(authors))
+        channel = SimpleNamespace(id=random.randrange(channels))
+        q.record_message(leaderboard, SimpleNamespace(id=snowflake(now, messages + i), author=author, channel=channel, created_at=now_dt))
+
+    existing = [row[0] for row in leaderboard.get().execute(
+        "SELECT message_id FROM messages ORDER BY random() LIMIT ?", (runs,)).fetchall()]
+    def delete(i):
+        q.delete_message(leaderboard, existing[i % len(existing)])
+
+    start_of_week = now_dt - timedelta(days=7)
+    start_of_last_week = now_dt - timedelta(days=14)
+    result["timings"] = {
+        "record_message": time_calls(record, runs),
+        "delete_message": time_calls(delete, runs),
+        "count_messages_weekly": time_calls(lambda i: q.count_messages(leaderboard, after=start_of_week, limit=10), runs),
+        "count_messages_lastweek": time_calls(lambda i: q.count_messages(leaderboard, after=start_of_last_week, before=start_of_week), runs),
+        "get_open_channel": time_calls(lambda i: q.get_open_channel(scene), runs),
+    }
+    leaderboard.close(wait=True)
+    scene.close(wait=True)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark queries.py against synthetic databases")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="numbers of messages to test with")
+    parser.add_argument("--authors", type=int, default=2000)
+    parser.add_argument("--channels", type=int, default=1000)
+    parser.add_argument("--runs", type=int, default=50, help="timed calls per query")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    report = {
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "date": datetime.utcnow().isoformat(timespec="seconds"),
+        "results": [],
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        db.DATABASE_DIR = directory
+        for size in args.sizes:
+            report["results"].append(bench_size(size, args.authors, args.channels, args.runs))
+
+    output = json.dumps(report, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w") as f:
+            f.write(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+# A small least-recently-used cache
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, max_size: int, on_evict=None):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        # Called with (key, value) for anything pushed out by put
+        self.on_evict = on_evict
+
+    def get(self, key, default=None):
+        '''Return the value for key, marking it as recently used'''
+        if key not in self.items:
+            return default
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def put(self, key, value):
+        '''Store a value, evicting the least recently used entry if the cache is full'''
+        self.items[key] = value
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            key, value = self.items.popitem(last=False)
+            if self.on_evict is not None:
+                self.on_evict(key, value)
+
+    def pop(self, key, default=None):
+        return self.items.pop(key, default)
+
+    def clear(self):
+        self.items.clear()
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
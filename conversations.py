@@ -0,0 +1,58 @@
+# Multi-step prompts that wait for someone's next message in a channel.
+# Waiters are keyed by (channel id, author id), so on_message finds the right one with a single lookup
+# instead of discord.py running every wait_for check against every message.
+import asyncio
+
+# Seconds to wait for each answer before giving up
+STEP_TIMEOUT = 300
+
+
+class Superseded(Exception):
+    '''A newer prompt started waiting for the same person in the same channel'''
+
+
+class Conversations:
+    def __init__(self, timeout: float = STEP_TIMEOUT):
+        self.timeout = timeout
+        # (channel id, author id) -> future that gets the next message
+        self.waiting = {}
+        self.answered = 0
+        self.timed_out = 0
+        self.superseded = 0
+
+    async def ask(self, channel_id: int, author_id: int, timeout: float = None):
+        '''Wait for the author's next message in the channel. Returns None if it times out, and raises
+        Superseded if another prompt starts waiting for the same person in the same channel.'''
+        key = (channel_id, author_id)
+        previous = self.waiting.get(key)
+        if previous is not None and not previous.done():
+            self.superseded += 1
+            previous.set_exception(Superseded())
+        future = asyncio.get_event_loop().create_future()
+        self.waiting[key] = future
+        try:
+            return await asyncio.wait_for(future, self.timeout if timeout is None else timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            return None
+        finally:
+            # Clean up, unless a newer prompt already took the slot
+            if self.waiting.get(key) is future:
+                del self.waiting[key]
+
+    def route(self, msg) -> bool:
+        '''Hand a message to whoever is waiting for it, returning whether anyone was'''
+        future = self.waiting.pop((msg.channel.id, msg.author.id), None)
+        if future is None or future.done():
+            return False
+        self.answered += 1
+        future.set_result(msg)
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "active": len(self.waiting),
+            "answered": self.answered,
+            "timed_out": self.timed_out,
+            "superseded": self.superseded,
+        }
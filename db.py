@@ -1,6 +1,14 @@
 # A very stripped-down migration management system
 import sqlite3
 import os
+import asyncio
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from urllib.parse import quote
+from cache import LRUCache
 
 MIGRATIONS = {
     "scene": [
@@ -21,6 +29,25 @@ MIGRATIONS = {
             -- A simple table to keep track of how many rp- channels exist
             CREATE TABLE channels(id INTEGER PRIMARY KEY);
             """
+        ],
+        [
+            """
+            -- get_open_channel looks for free channels
+            CREATE INDEX channel_scenes_created ON channel_scenes(created);
+            """
+        ],
+        [
+            """
+            -- list_idle_scenes looks for scenes with no posts since some time
+            CREATE INDEX channel_scenes_updated ON channel_scenes(updated);
+            """
+        ],
+        [
+            """
+            -- Until posts were tracked, updated only held when the scene was opened.
+            -- Start every open scene's clock from now, so none are ended as idle before anyone had a chance to post.
+            UPDATE channel_scenes SET updated = datetime('now') WHERE created IS NOT NULL;
+            """
         ]
     ],
     "leaderboard": [
@@ -34,53 +61,352 @@ MIGRATIONS = {
                 message_id INTEGER
             );
             """
+        ],
+        [
+            """
+            -- delete_message looks up by message id
+            CREATE INDEX messages_message_id ON messages(message_id);
+            """,
+            """
+            -- count_messages filters by date and groups by author, so cover both
+            CREATE INDEX messages_date_author ON messages(date, author);
+            """
+        ],
+        [
+            """
+            -- Per-author message counts in hourly buckets, kept up to date by record_messages and delete_message.
+            -- hour is the number of hours since the unix epoch.
+            CREATE TABLE message_counts(
+                hour INTEGER,
+                author INTEGER,
+                count INTEGER,
+                PRIMARY KEY(hour, author)
+            ) WITHOUT ROWID;
+            """,
+            """
+            INSERT INTO message_counts(hour, author, count)
+                SELECT CAST(strftime('%s', date) AS INTEGER) / 3600, author, COUNT(*) FROM messages GROUP BY 1, 2;
+            """
+        ],
+        [
+            """
+            -- Key messages by their snowflake id, and store the date as seconds since the unix epoch
+            CREATE TABLE messages_compact(
+                message_id INTEGER PRIMARY KEY,
+                author INTEGER,
+                date INTEGER,
+                channel_id INTEGER
+            ) WITHOUT ROWID;
+            """,
+            """
+            INSERT OR IGNORE INTO messages_compact(message_id, author, date, channel_id)
+                SELECT message_id, author, CAST(strftime('%s', date) AS INTEGER), channel_id FROM messages;
+            """,
+            """
+            DROP TABLE messages;
+            """,
+            """
+            ALTER TABLE messages_compact RENAME TO messages;
+            """,
+            """
+            CREATE INDEX messages_date_author ON messages(date, author);
+            """,
+            """
+            -- Recount in case there were any duplicate message ids
+            DELETE FROM message_counts;
+            """,
+            """
+            INSERT INTO message_counts(hour, author, count)
+                SELECT date / 3600, author, COUNT(*) FROM messages GROUP BY 1, 2;
+            """
+        ],
+        [
+            """
+            -- How far /backfill has got through each channel's history, which it reads newest first.
+            -- oldest_id is the oldest message seen so far, and done is 1 once the start of the channel was reached.
+            CREATE TABLE backfill_progress(
+                channel_id INTEGER PRIMARY KEY,
+                oldest_id INTEGER,
+                done INTEGER
+            );
+            """
+        ],
+        [
+            """
+            -- Per-author totals for days whose raw messages were removed by compact_day.
+            -- day is the number of days since the unix epoch, and no day is in both this and message_counts.
+            CREATE TABLE daily_counts(
+                day INTEGER,
+                author INTEGER,
+                count INTEGER,
+                PRIMARY KEY(day, author)
+            ) WITHOUT ROWID;
+            """
         ]
     ]
 }
 
 
+# Where the database files live
+DATABASE_DIR = "databases"
+# Read-only connections per database, each on its own thread
+READERS = 2
+# Run on every connection when it's opened. The writer also switches the file to WAL,
+# so readers don't block the writer and vice versa.
+PRAGMAS = [
+    # With WAL, commits don't need a full fsync of the main file
+    "PRAGMA synchronous=NORMAL;",
+    # Negative means KiB, so this is 8 MiB of page cache
+    "PRAGMA cache_size=-8192;",
+    "PRAGMA mmap_size=67108864;",
+]
+
+
+# (server type, server id) -> schema version, for databases known to be up to date
+SCHEMA_VERSIONS = {}
+# Threads used by migrate_all
+MIGRATION_WORKERS = 4
+DATABASE_FILE = re.compile(r'^(-?\d+) (\w+)\.db$')
+
+
+def database_path(server_type: str, server_id: int) -> str:
+    return os.path.join(DATABASE_DIR, f'{server_id} {server_type}.db')
+
+def current_version(conn) -> int:
+    '''Create the version table if it doesnt exist and return the schema version'''
+    cursor = conn.cursor()
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS _version(id INTEGER PRIMARY KEY AUTOINCREMENT, date NUMERIC, version INTEGER);
+    """)
+    version = cursor.execute("""
+        SELECT max(version) FROM _version;
+    """).fetchone()
+    return 0 if version[0] is None else version[0]
+
+def migrate(conn, server_type: str, start_version: int):
+    '''Apply the migrations after start_version in order, each in its own transaction'''
+    migration = MIGRATIONS[server_type]
+    cursor = conn.cursor()
+    for i in range(start_version, len(migration)):
+        cursor.execute("BEGIN;")
+        try:
+            for statement in migration[i]:
+                cursor.execute(statement)
+            cursor.execute("""INSERT INTO _version(date, version) VALUES(datetime('now', 'utc'), ?);""", (i+1,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+class DatabaseClosed(Exception):
+    '''A Database was used after close(). Get a fresh one from get_database instead.'''
+
+
 class Database:
     def __init__(self, server_type: str, server_id: int):
         self.server_type = server_type
         self.server_id = server_id
-        self.conn = sqlite3.connect(f'databases/{server_id} {server_type}.db')
-        # Create version table if it doesnt exist and check version
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS _version(id INTEGER PRIMARY KEY AUTOINCREMENT, date NUMERIC, version INTEGER);
-        """)
-        version = cursor.execute("""
-            SELECT max(version) FROM _version;
-        """).fetchone()
-        version = 0 if version[0] is None else version[0]
-        self.upgrade(version)
+        self.open()
+        # Skip the version check if migrate_all (or an earlier Database) already did it
+        latest = len(MIGRATIONS[server_type])
+        if SCHEMA_VERSIONS.get((server_type, server_id)) != latest:
+            self.upgrade(current_version(self.conn))
+            SCHEMA_VERSIONS[(server_type, server_id)] = latest
+
+    def open(self):
+        # Writes happen on their own thread, so the writer connection is shared with it
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'db-{self.server_id}-{self.server_type}')
+        self.conn = self.connect()
+        # Only takes effect on a new file. migrate_file switches existing ones over.
+        self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+        self.conn.execute("PRAGMA journal_mode=WAL;")
+        # Reads happen on a few other threads, each with its own read-only connection
+        self.read_executor = ThreadPoolExecutor(max_workers=READERS, thread_name_prefix=f'db-{self.server_id}-{self.server_type}-read')
+        self.local = threading.local()
+        self.readers = []
+        self.readers_lock = threading.Lock()
+        self.closed = False
+
+    def path(self) -> str:
+        return database_path(self.server_type, self.server_id)
+
+    def connect(self, read_only: bool = False):
+        if read_only:
+            conn = sqlite3.connect(f'file:{quote(self.path())}?mode=ro', uri=True, check_same_thread=False)
+        else:
+            conn = sqlite3.connect(self.path(), check_same_thread=False)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def close(self, wait: bool = False):
+        '''Close the connections once the work already queued is done. Nothing new can be queued after this.
+        Only wait for that from outside the event loop, since a long query would hold it up.'''
+        if self.closed:
+            return
+        self.closed = True
+        def close_connections():
+            # The last job on the writer thread, so every write is done. Wait for the reads too.
+            self.read_executor.shutdown(wait=True)
+            for reader in self.readers:
+                reader.close()
+            self.conn.close()
+        self.executor.submit(close_connections)
+        self.executor.shutdown(wait=wait)
+
+    def check_open(self):
+        if self.closed:
+            raise DatabaseClosed(f'{self.path()} was closed')
 
     def get(self):
         return self.conn.cursor()
+
+    def read(self):
+        '''A cursor on this thread's read-only connection, which only sees committed data'''
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = self.connect(read_only=True)
+            with self.readers_lock:
+                self.readers.append(conn)
+        return conn.cursor()
     
     def commit(self):
         self.conn.commit()
 
+    async def run(self, f, *args, **kwargs):
+        '''Await f(self, *args, **kwargs) on this database's writer thread'''
+        self.check_open()
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, partial(f, self, *args, **kwargs))
+
+    async def run_read(self, f, *args, **kwargs):
+        '''Await f(self, *args, **kwargs) on one of this database's reader threads'''
+        self.check_open()
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.read_executor, partial(f, self, *args, **kwargs))
+
+    def call(self, f, *args, **kwargs):
+        '''Run f(self, *args, **kwargs) on this database's writer thread and block until it's done'''
+        self.check_open()
+        return self.executor.submit(f, self, *args, **kwargs).result()
+
     def upgrade(self, start_version: int):
-        # retrieve the migrations
-        migration = MIGRATIONS[self.server_type]
-        # execute required migrations in order        
-        cursor = self.get()
-        for i in range(start_version, len(migration)):
-            for statement in migration[i]:
-                cursor.execute(statement)
-            cursor.execute("""INSERT INTO _version(date, version) VALUES(datetime('now', 'utc'), ?);""", (i+1,))
-        self.commit()
+        migrate(self.conn, self.server_type, start_version)
+
+
+# At most this many databases are open at once
+MAX_OPEN_DATABASES = 64
+# Databases that haven't been used for this many seconds get closed
+IDLE_TIMEOUT = 600
+
+class DatabasePool:
+    '''Keeps a bounded number of databases open, closing the least recently used ones'''
+    def __init__(self, max_open: int = MAX_OPEN_DATABASES, idle_timeout: float = IDLE_TIMEOUT):
+        self.idle_timeout = idle_timeout
+        self.databases = LRUCache(max_open, on_evict=self.evicted)
+        self.last_used = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.idle_closes = 0
+
+    def get(self, server_type: str, server_id: int) -> Database:
+        key = (server_type, server_id)
+        self.last_used[key] = time.monotonic()
+        db = self.databases.get(key)
+        if db is not None:
+            self.hits += 1
+            return db
+        self.misses += 1
+        db = Database(server_type, server_id)
+        self.databases.put(key, db)
+        return db
+
+    def evicted(self, key, db: Database):
+        self.evictions += 1
+        self.last_used.pop(key, None)
+        db.close()
+
+    def close_idle(self):
+        '''Close every database that hasn't been used within the idle timeout'''
+        cutoff = time.monotonic() - self.idle_timeout
+        for key in [key for key, used in self.last_used.items() if used < cutoff]:
+            self.idle_closes += 1
+            del self.last_used[key]
+            self.databases.pop(key).close()
+
+    def close_all(self):
+        for db in self.databases.items.values():
+            db.close(wait=True)
+        self.databases.clear()
+        self.last_used.clear()
+
+    def stats(self) -> dict:
+        return {
+            "open": len(self.databases),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "idle_closes": self.idle_closes,
+        }
+
+    async def run(self, interval: float = 60):
+        '''Periodically close idle databases'''
+        while True:
+            await asyncio.sleep(interval)
+            self.close_idle()
+
+
+def find_databases():
+    '''Return (server type, server id) for every database file in DATABASE_DIR'''
+    found = []
+    for name in sorted(os.listdir(DATABASE_DIR)):
+        match = DATABASE_FILE.match(name)
+        if match is not None and match.group(2) in MIGRATIONS:
+            found.append((match.group(2), int(match.group(1))))
+    return found
+
+def enable_incremental_vacuum(conn) -> bool:
+    '''Switch a file to incremental auto-vacuum if it isn't already, returning whether it had to.
+    That takes a full VACUUM, which rewrites the whole file, so it's only done before the bot starts.'''
+    if conn.execute("PRAGMA auto_vacuum;").fetchone()[0] == 2:
+        return False
+    conn.execute("PRAGMA auto_vacuum=INCREMENTAL;")
+    conn.execute("VACUUM;")
+    return True
+
+def migrate_file(server_type: str, server_id: int) -> int:
+    '''Bring one database file up to date, returning the version it started at'''
+    conn = sqlite3.connect(database_path(server_type, server_id))
+    try:
+        version = current_version(conn)
+        migrate(conn, server_type, version)
+        # So the retention task can give space back in small slices later
+        enable_incremental_vacuum(conn)
+    finally:
+        conn.close()
+    SCHEMA_VERSIONS[(server_type, server_id)] = len(MIGRATIONS[server_type])
+    return version
+
+def migrate_all(workers: int = MIGRATION_WORKERS, progress=None):
+    '''Migrate every database file in parallel, so it doesn't happen lazily in the middle of traffic.
+    progress(done, total, (server type, server id), version it started at or the exception) is called after each one.'''
+    found = find_databases()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="migrate") as executor:
+        futures = {executor.submit(migrate_file, *key): key for key in found}
+        for done, future in enumerate(as_completed(futures), 1):
+            # A failed database is reported and left for the lazy check to try again
+            result = future.exception() or future.result()
+            if progress is not None:
+                progress(done, len(found), futures[future], result)
 
 
-OPEN_DATABASES = {}
+POOL = DatabasePool()
 def get_database(server_type: str, server_id: int) -> Database:
-    key = (server_type, server_id)
-    if key not in OPEN_DATABASES:
-        OPEN_DATABASES[key] = Database(server_type, server_id)
-    return OPEN_DATABASES[key]
+    return POOL.get(server_type, server_id)
 
 
 if __name__ == "__main__":
-    os.makedirs("databases", exist_ok=True)
+    os.makedirs(DATABASE_DIR, exist_ok=True)
     db = Database("scene", 0)
\ No newline at end of file
@@ -0,0 +1,123 @@
+# Dice rolling that works from face counts, so huge pools don't need a list with one entry per die
+import math
+import random
+from functools import lru_cache
+
+FACES = range(1, 11)
+# Below this, binomials are sampled by flipping every coin. Above it, the normal approximation is very good.
+EXACT_BINOMIAL_LIMIT = 1000
+
+
+def roll_heuristic(die, diff, specialized=False, no_botch=False):
+    if specialized and die == 10:
+        return 2
+    if die >= diff:
+        return 1
+    if die == 1 and not no_botch:
+        return -1
+    return 0
+
+def binomial(n: int, p: float) -> int:
+    '''Sample how many of n trials succeed with probability p each'''
+    if p <= 0:
+        return 0
+    if p >= 1:
+        return n
+    if n <= EXACT_BINOMIAL_LIMIT:
+        return sum(1 for _ in range(n) if random.random() < p)
+    if hasattr(random, "binomialvariate"):
+        return random.binomialvariate(n, p)
+    k = round(random.gauss(n * p, math.sqrt(n * p * (1 - p))))
+    return min(n, max(0, k))
+
+def roll_faces(pool: int):
+    '''Roll pool d10s and return how many landed on each face, as a dict of face -> count'''
+    faces = {}
+    remaining = pool
+    # Each face takes its share of the dice that haven't landed on an earlier face
+    for face in FACES:
+        count = binomial(remaining, 1 / (11 - face))
+        faces[face] = count
+        remaining -= count
+    return faces
+
+def count_faces(rolls):
+    '''Turn a list of rolls into a dict of face -> count'''
+    faces = {face: 0 for face in FACES}
+    for roll in rolls:
+        faces[roll] += 1
+    return faces
+
+def count_successes(faces, diff, specialized=False, no_botch=False) -> int:
+    '''Total up roll_heuristic over every die'''
+    return sum(count * roll_heuristic(face, diff, specialized, no_botch) for face, count in faces.items())
+
+def describe_faces(faces) -> str:
+    '''A short summary like "1×3, 4×2, 10×1", skipping faces nobody rolled'''
+    return ", ".join(f"{face}×{count}" for face, count in faces.items() if count > 0)
+
+def summarize_emoji(faces, get_emoji) -> str:
+    '''Group the faces by the emoji they'd show as, like ":x: ×5 :star2: ×2"'''
+    totals = {}
+    for face, count in faces.items():
+        if count > 0:
+            emoji = get_emoji(face)
+            totals[emoji] = totals.get(emoji, 0) + count
+    return " ".join(f"{emoji} ×{count}" for emoji, count in totals.items())
+
+#
+# ODDS
+#
+
+# Probabilities smaller than this are dropped from the ends of a distribution
+NEGLIGIBLE = 1e-15
+
+def trim(offset: int, probs):
+    '''Drop negligible probabilities from both ends of a distribution'''
+    start = 0
+    end = len(probs)
+    while end - start > 1 and probs[start] < NEGLIGIBLE:
+        start += 1
+    while end - start > 1 and probs[end - 1] < NEGLIGIBLE:
+        end -= 1
+    return offset + start, tuple(probs[start:end])
+
+def convolve(a, b):
+    '''Add two independent distributions, each given as (lowest value, probabilities)'''
+    a_offset, a_probs = a
+    b_offset, b_probs = b
+    probs = [0.0] * (len(a_probs) + len(b_probs) - 1)
+    for i, p in enumerate(a_probs):
+        if p == 0:
+            continue
+        for j, r in enumerate(b_probs):
+            probs[i + j] += p * r
+    return trim(a_offset + b_offset, probs)
+
+@lru_cache(maxsize=1024)
+def net_distribution(pool: int, diff: int, specialized: bool = False):
+    '''Exact distribution of roll_heuristic summed over pool dice, as (lowest value, probabilities)'''
+    if pool == 0:
+        return 0, (1.0,)
+    if pool == 1:
+        probs = [0.0] * 4
+        for face in FACES:
+            probs[roll_heuristic(face, diff, specialized) + 1] += 0.1
+        return trim(-1, probs)
+    # Splitting in half means only about 2 log(pool) distributions ever get computed
+    half = pool // 2
+    return convolve(net_distribution(half, diff, specialized), net_distribution(pool - half, diff, specialized))
+
+def success_odds(pool: int, diff: int, specialized: bool = False, willpower: bool = False):
+    '''Return ({successes: probability}, botch probability), where a negative total is a botch'''
+    offset, probs = net_distribution(pool, diff, specialized)
+    odds = {}
+    botch = 0.0
+    for net, p in enumerate(probs, offset):
+        if net < 0 and not willpower:
+            botch += p
+            continue
+        # Willpower turns a botch into one success and adds one to anything else
+        successes = (1 if net < 0 else net + 1) if willpower else net
+        odds[successes] = odds.get(successes, 0.0) + p
+    return odds, botch
@@ -0,0 +1,80 @@
+# Channel topic edits are heavily rate limited, so they go through a queue that only keeps the newest topic
+import asyncio
+import time
+import traceback
+from collections import deque
+
+# Discord allows this many topic edits per channel in EDIT_WINDOW seconds
+EDIT_BUDGET = 2
+EDIT_WINDOW = 600
+
+
+class TopicScheduler:
+    def __init__(self, budget: int = EDIT_BUDGET, window: float = EDIT_WINDOW):
+        self.budget = budget
+        self.window = window
+        # channel id -> (channel, topic, reason, time it was asked for)
+        self.pending = {}
+        # channel id -> the task applying its edits
+        self.workers = {}
+        # channel id -> times of its recent edits
+        self.recent = {}
+        self.edits = 0
+        self.superseded = 0
+        self.dropped = 0
+        self.failed = 0
+        # Seconds from asking for a topic to it being applied, for the latest edits
+        self.latencies = deque(maxlen=100)
+
+    def set_topic(self, channel, topic: str, reason: str = None):
+        '''Ask for a channel's topic to be changed, replacing any change that hasn't happened yet'''
+        if channel.id in self.pending:
+            self.superseded += 1
+        self.pending[channel.id] = (channel, topic, reason, time.monotonic())
+        worker = self.workers.get(channel.id)
+        if worker is None or worker.done():
+            self.workers[channel.id] = asyncio.ensure_future(self.work(channel.id))
+
+    def wait_time(self, channel_id: int) -> float:
+        '''Seconds until the channel has budget for another edit'''
+        recent = self.recent.setdefault(channel_id, deque())
+        now = time.monotonic()
+        while recent and recent[0] <= now - self.window:
+            recent.popleft()
+        if len(recent) < self.budget:
+            return 0
+        return recent[0] + self.window - now
+
+    async def work(self, channel_id: int):
+        while channel_id in self.pending:
+            wait = self.wait_time(channel_id)
+            if wait > 0:
+                # Anything asked for while we wait replaces what's pending
+                await asyncio.sleep(wait)
+                continue
+            channel, topic, reason, asked_at = self.pending.pop(channel_id)
+            if channel.topic == topic:
+                # Already there, probably because an open and a close cancelled out
+                self.dropped += 1
+                continue
+            self.recent[channel_id].append(time.monotonic())
+            try:
+                await channel.edit(topic=topic, reason=reason)
+                self.edits += 1
+                self.latencies.append(time.monotonic() - asked_at)
+            except Exception:
+                self.failed += 1
+                traceback.print_exc()
+        del self.workers[channel_id]
+
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            "queued": len(self.pending),
+            "edits": self.edits,
+            "superseded": self.superseded,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "median_latency": latencies[len(latencies) // 2] if latencies else None,
+            "max_latency": latencies[-1] if latencies else None,
+        }
@@ -0,0 +1,353 @@
+# Load test for main.py without a Discord connection.
+# Gateway events are replayed into the real handlers, with fake guilds, channels and members standing in
+# for discord's objects and a fake HTTP client that just waits a while instead of calling the API.
+# Events come from a file written by running the bot with RECORD_EVENTS set, or are made up on the spot:
+#   python loadtest.py --duration 60 --rate 50 --speed 4
+#   python loadtest.py --events events.jsonl --speed 10 --output results.json
+import argparse
+import asyncio
+import json
+import platform
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import datetime
+import db
+import main as bot
+
+# Roughly how long Discord takes to answer an API call, in seconds
+API_LATENCY = 0.05
+# How often to check the event loop for lag, in seconds
+LAG_INTERVAL = 0.01
+# Seconds to let handlers finish after the last event, before giving up on prompts nobody answered
+GRACE_PERIOD = 5
+DISCORD_EPOCH = 1420070400000
+BOT_ID = 1
+
+
+def snowflake() -> int:
+    '''A fresh discord-style id for something created now'''
+    snowflake.sequence += 1
+    return ((int(time.time() * 1000) - DISCORD_EPOCH) << 22) | (snowflake.sequence % (1 << 22))
+snowflake.sequence = 0
+
+
+class FakeHTTP:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+
+    async def request(self):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+
+    async def send_message(self, channel_id, content, **kwargs):
+        await self.request()
+        return {"id": snowflake(), "channel_id": channel_id, "content": content}
+
+    async def send_files(self, channel_id, **kwargs):
+        return await self.send_message(channel_id, kwargs.get("content"))
+
+    async def send_typing(self, channel_id):
+        await self.request()
+
+
+class FakeState:
+    '''Stands in for discord's connection state, which is what Messageable.send talks to'''
+    def __init__(self, http: FakeHTTP):
+        self.http = http
+        self.loop = bot.client.loop
+        self.allowed_mentions = None
+
+    def create_message(self, channel, data):
+        return FakeMessage(self, channel, None, data["content"], data["id"])
+
+
+class FakeMember:
+    def __init__(self, member_id: int, is_bot: bool = False):
+        self.id = member_id
+        self.name = f"member{member_id}"
+        self.nick = None
+        self.display_name = self.name
+        self.mention = f"<@{member_id}>"
+        self.bot = is_bot
+        self.color = 0
+        self.avatar_url = ""
+        self.roles = []
+
+
+class FakeChannel:
+    def __init__(self, state: FakeState, guild, channel_id: int, name: str, category_id: int = None):
+        self._state = state
+        self.guild = guild
+        self.id = channel_id
+        self.name = name
+        self.category_id = category_id
+        self.mention = f"<#{channel_id}>"
+        self.topic = None
+
+    async def send(self, content=None, embed=None, file=None):
+        data = await self._state.http.send_message(self.id, content)
+        return self._state.create_message(self, data)
+
+    async def edit(self, topic=None, reason=None):
+        await self._state.http.request()
+        self.topic = topic
+
+    async def delete_messages(self, messages):
+        await self._state.http.request()
+
+
+class FakeGuild:
+    def __init__(self, state: FakeState, guild_id: int):
+        self._state = state
+        self.id = guild_id
+        self.name = f"guild{guild_id}"
+        self.channels = {}
+        self.members = {}
+        self.add_channel(bot.ROLEPLAY_CHANNELS_CATEGORY, "roleplay")
+        self.add_channel(bot.SCENE_LOG, "scene-log")
+        for channel_id in bot.BOT_CHANNELS:
+            self.add_channel(channel_id, "bots")
+
+    def add_channel(self, channel_id: int, name: str, category_id: int = None) -> FakeChannel:
+        channel = self.channels[channel_id] = FakeChannel(self._state, self, channel_id, name, category_id)
+        return channel
+
+    def get_channel(self, channel_id: int):
+        return self.channels.get(channel_id)
+
+    def channel(self, channel_id: int, category_id: int = None) -> FakeChannel:
+        if channel_id not in self.channels:
+            self.add_channel(channel_id, f"channel{channel_id}", category_id)
+        return self.channels[channel_id]
+
+    def get_member(self, member_id: int):
+        return self.members.get(member_id)
+
+    def member(self, member_id: int) -> FakeMember:
+        if member_id not in self.members:
+            self.members[member_id] = FakeMember(member_id)
+        return self.members[member_id]
+
+    async def create_text_channel(self, name: str, category=None):
+        await self._state.http.request()
+        return self.add_channel(snowflake(), name, None if category is None else category.id)
+
+
+class FakeMessage:
+    def __init__(self, state: FakeState, channel: FakeChannel, author: FakeMember, content: str, message_id: int):
+        self._state = state
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.id = message_id
+        self.created_at = datetime.utcnow()
+
+    async def delete(self, delay=None):
+        await self._state.http.request()
+
+
+class FakeDeletePayload:
+    def __init__(self, guild_id: int, channel_id: int, message_ids):
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.message_id = message_ids[0]
+        self.message_ids = set(message_ids)
+
+
+#
+# EVENTS
+#
+
+def synthetic_events(duration: float, rate: float, guilds: int, members: int, channels: int, commands: float):
+    '''Make up events in the format RECORD_EVENTS writes: mostly roleplay posts, with some deletes and commands'''
+    prefix = bot.client.command_prefix
+    events = []
+    posted = []
+    t = 0.0
+    while True:
+        t += random.expovariate(rate)
+        if t >= duration:
+            break
+        guild = random.randrange(guilds) + 1
+        author = 1000 + random.randrange(members)
+        kind = random.random()
+        if kind < commands:
+            channel = bot.BOT_CHANNELS[0]
+            command = random.choice(["r", "r", "r", "batch", "weekly", "scene"])
+            if command == "r":
+                content = f"{prefix}r {random.randint(1, 12)} {random.randint(3, 9)}"
+            elif command == "batch":
+                content = f"{prefix}batch " + "\n".join(f"{random.randint(1, 12)} {random.randint(3, 9)}" for _ in range(random.randint(2, 6)))
+            elif command == "weekly":
+                content = f"{prefix}weekly"
+            else:
+                content = f"{prefix}scene Load test {len(events)}"
+                # The answers to /scene's questions come a little later
+                for delay, answer in [(2.0, "Some characters"), (4.0, "Somewhere")]:
+                    events.append({"t": t + delay, "type": "message", "guild": guild, "channel": channel,
+                        "category": None, "author": author, "id": snowflake(), "content": answer})
+            events.append({"t": t, "type": "message", "guild": guild, "channel": channel,
+                "category": None, "author": author, "id": snowflake(), "content": content})
+        elif kind < commands + 0.05 and posted:
+            victim = posted.pop(random.randrange(len(posted)))
+            events.append({"t": t, "type": "delete", "guild": victim["guild"], "channel": victim["channel"], "ids": [victim["id"]]})
+        else:
+            channel = 10_000 + random.randrange(channels)
+            event = {"t": t, "type": "message", "guild": guild, "channel": channel,
+                "category": bot.ROLEPLAY_CHANNELS_CATEGORY, "author": author, "id": snowflake(), "content": ""}
+            events.append(event)
+            posted.append(event)
+    events.sort(key=lambda event: event["t"])
+    return events
+
+def read_events(path: str):
+    with open(path) as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    start = events[0]["t"] if events else 0
+    for event in events:
+        event["t"] -= start
+    return events
+
+def handler_name(event, prefix: str) -> str:
+    '''What to file an event's latency under. Commands that ask questions, like /scene, include the wait for answers.'''
+    if event["type"] == "delete":
+        # A recorded /clear_last is one event with all of its ids
+        return "on_raw_message_delete" if len(event["ids"]) == 1 else "on_raw_bulk_message_delete"
+    content = event.get("content") or ""
+    if content.startswith(prefix) and len(content) > len(prefix):
+        return "command " + content[len(prefix):].split()[0]
+    return "on_message"
+
+
+#
+# REPLAY
+#
+
+def percentiles(times):
+    times = sorted(times)
+    pick = lambda q: times[min(len(times) - 1, int(len(times) * q))] * 1000
+    return {
+        "count": len(times),
+        "p50_ms": pick(0.5),
+        "p95_ms": pick(0.95),
+        "p99_ms": pick(0.99),
+        "max_ms": times[-1] * 1000,
+    }
+
+async def sample_lag(lags: list, stopping: asyncio.Event):
+    while not stopping.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(LAG_INTERVAL)
+        lags.append(max(0.0, time.perf_counter() - start - LAG_INTERVAL))
+
+async def replay(events, speed: float, api_latency: float):
+    '''Feed events to the handlers at speed times their original pace, and report how it went'''
+    http = FakeHTTP(api_latency)
+    state = FakeState(http)
+    bot.client._connection.user = FakeMember(BOT_ID, is_bot=True)
+    prefix = bot.client.command_prefix
+    guilds = {}
+    latencies = {}
+    failures = {}
+
+    async def handle(event):
+        guild = guilds.get(event["guild"])
+        if guild is None:
+            guild = guilds[event["guild"]] = FakeGuild(state, event["guild"])
+        channel = guild.channel(event["channel"], event.get("category"))
+        name = handler_name(event, prefix)
+        start = time.perf_counter()
+        try:
+            if event["type"] == "delete" and len(event["ids"]) == 1:
+                await bot.on_raw_message_delete(FakeDeletePayload(guild.id, channel.id, event["ids"]))
+            elif event["type"] == "delete":
+                await bot.on_raw_bulk_message_delete(FakeDeletePayload(guild.id, channel.id, event["ids"]))
+            else:
+                author = guild.member(event["author"])
+                await bot.on_message(FakeMessage(state, channel, author, event.get("content") or "", event["id"]))
+        except Exception:
+            failures[name] = failures.get(name, 0) + 1
+        latencies.setdefault(name, []).append(time.perf_counter() - start)
+
+    background = [asyncio.ensure_future(task) for task in [bot.recorder.run(), db.POOL.run()]]
+    lags = []
+    stopping = asyncio.Event()
+    sampler = asyncio.ensure_future(sample_lag(lags, stopping))
+    tasks = []
+    start = time.perf_counter()
+    for event in events:
+        delay = start + event["t"] / speed - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(handle(event)))
+    await asyncio.wait(tasks, timeout=GRACE_PERIOD)
+    # A recording can stop in the middle of someone answering /scene, so don't wait out the prompt timeout
+    for future in list(bot.conversations.waiting.values()):
+        if not future.done():
+            future.set_result(None)
+    await asyncio.gather(*tasks)
+    await bot.recorder.flush()
+    elapsed = time.perf_counter() - start
+    stopping.set()
+    await sampler
+    for task in background:
+        task.cancel()
+
+    return {
+        "events": len(events),
+        "speed": speed,
+        "seconds": elapsed,
+        "events_per_second": len(events) / elapsed if elapsed > 0 else 0.0,
+        "api_calls": http.calls,
+        "max_loop_lag_ms": max(lags, default=0.0) * 1000,
+        "handlers": {name: percentiles(times) for name, times in sorted(latencies.items())},
+        "failures": failures,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay gateway events into main.py's handlers")
+    parser.add_argument("--events", help="a file written with RECORD_EVENTS, instead of made-up events")
+    parser.add_argument("--speed", type=float, default=1.0, help="how many times faster than real time to replay")
+    parser.add_argument("--duration", type=float, default=60, help="seconds of made-up events")
+    parser.add_argument("--rate", type=float, default=20, help="made-up events per second")
+    parser.add_argument("--guilds", type=int, default=1)
+    parser.add_argument("--members", type=int, default=50)
+    parser.add_argument("--channels", type=int, default=20)
+    parser.add_argument("--commands", type=float, default=0.05, help="fraction of made-up events that are commands")
+    parser.add_argument("--api-latency", type=float, default=API_LATENCY, help="seconds each fake API call takes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    if args.events is not None:
+        events = read_events(args.events)
+    else:
+        events = synthetic_events(args.duration, args.rate, args.guilds, args.members, args.channels, args.commands)
+    report = {
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "date": datetime.utcnow().isoformat(timespec="seconds"),
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        db.DATABASE_DIR = directory
+        try:
+            report.update(bot.client.loop.run_until_complete(replay(events, args.speed, args.api_latency)))
+        finally:
+            db.POOL.close_all()
+
+    output = json.dumps(report, indent=2)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w") as f:
+            f.write(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,46 @@
 import asyncio
 import discord
+import json
 from discord.ext import commands
 from datetime import datetime, timezone, timedelta
 import random
 import os
-from db import get_database
+import time
+import traceback
+from db import get_database, migrate_all, DATABASE_DIR, POOL
 import queries as q
+import aqueries as aq
 from help import help
+from recorder import MessageRecorder
+from retention import Compactor
+from cache import LRUCache
+import dice
+from scenes import get_allocator, ActivityTracker, IDLE_SCENE_DAYS
+from edits import TopicScheduler
+from conversations import Conversations, Superseded
+import metrics
+from profiler import SamplingProfiler, PROFILE_DIR
 
 if os.getenv("DEVELOPMENT_ENVIRONMENT"):
     client = commands.Bot('?')
 else:
     client = commands.Bot('/')
 
+# Formatted leaderboards per guild, keyed by (before, after, limit)
+LEADERBOARD_CACHE_SIZE = 8
+leaderboard_cache = {}
+
+def invalidate_leaderboards(guild_id: int):
+    '''Forget the cached leaderboards for a guild, since its messages changed'''
+    leaderboard_cache.pop(guild_id, None)
+
+# Leaderboard writes and deletions are buffered and flushed in batches
+recorder = MessageRecorder(on_write=invalidate_leaderboards)
+# Messages older than the retention window are folded into daily totals in the background
+compactor = Compactor(on_write=invalidate_leaderboards)
+# Prompts waiting for someone's answer, like the questions /scene asks
+conversations = Conversations()
+
 ROLEPLAY_CHANNELS_CATEGORY = 731098249275899947
 BOT_CHANNELS = [732660335424569456, 734420054724051014, 733979833758908516]
 ROLE_TORPID = 747031337759801404
@@ -36,33 +64,70 @@ def get_clan(guild, clan_name: str):
 
 def handle_error(f):
     async def inner(ctx, *args, **kwargs):
+        start = time.perf_counter()
         try:
             await f(ctx, *args, **kwargs)
         except Exception as e:
             await ctx.send("Oh no, something went wrong! Please alert <@164963698274729985>!")
             raise e
+        finally:
+            metrics.observe(metrics.COMMANDS, ctx.command.name if ctx.command else f.__name__, time.perf_counter() - start)
     return inner
 
+# Set RECORD_EVENTS to a file name to log messages and deletions there, for loadtest.py to replay
+RECORD_EVENTS = os.getenv("RECORD_EVENTS")
+event_log = None if RECORD_EVENTS is None else open(RECORD_EVENTS, "a", buffering=1)
+
+def record_event(event: dict):
+    event["t"] = time.time()
+    event_log.write(json.dumps(event) + "\n")
+
 @client.event
 async def on_ready():
     print("mrow")
 
 @client.event
+@metrics.timed(metrics.EVENTS)
 async def on_message(msg):
     '''Do all handling related to checking for messages'''
     if msg.channel.category_id == ROLEPLAY_CHANNELS_CATEGORY:
         # Count!
-        db = get_database("leaderboard", msg.guild.id)
-        q.record_message(db, msg)
+        await recorder.record(msg)
+        metrics.MESSAGES_RECORDED.inc()
+        # Our own notices don't keep a scene going
+        if not msg.author.bot:
+            activity.touch(msg)
+    # Answer a prompt if one is waiting on this person here
+    answered = conversations.route(msg)
+    if event_log is not None and msg.guild is not None:
+        # Only keep what's needed to replay commands and prompts, not what people wrote
+        content = msg.content if answered or msg.content.startswith(client.command_prefix) else ""
+        record_event({"type": "message", "guild": msg.guild.id, "channel": msg.channel.id, "category": msg.channel.category_id,
+            "author": msg.author.id, "id": msg.id, "content": content})
     # Do other command processing too
     await client.process_commands(msg)
 
 @client.event
+@metrics.timed(metrics.EVENTS)
 async def on_raw_message_delete(payload):
-    db = get_database("leaderboard", payload.guild_id)
-    q.delete_message(db, payload.message_id)
+    if payload.guild_id is None:
+        return
+    # Deletions are batched along with new messages
+    await recorder.delete(payload.guild_id, [payload.message_id])
+    if event_log is not None:
+        record_event({"type": "delete", "guild": payload.guild_id, "channel": payload.channel_id, "ids": [payload.message_id]})
     print(f'Deleted msg with id {payload.message_id}')
 
+@client.event
+@metrics.timed(metrics.EVENTS)
+async def on_raw_bulk_message_delete(payload):
+    if payload.guild_id is None:
+        return
+    await recorder.delete(payload.guild_id, payload.message_ids)
+    if event_log is not None:
+        record_event({"type": "delete", "guild": payload.guild_id, "channel": payload.channel_id, "ids": list(payload.message_ids)})
+    print(f'Deleted {len(payload.message_ids)} msgs in bulk')
+
 #
 # DICE COMMANDS
 #
@@ -96,74 +161,105 @@ def get_nick_or_name(ctx):
         return author.nick
     return author.name
 
-def roll_heuristic(die, diff, specialized=False, no_botch=False):
-    if specialized and die == 10:
-        return 2
-    if die >= diff:
-        return 1
-    if die == 1 and not no_botch:
-        return -1
-    return 0
-    
-async def handle_roll(ctx, pool: int, args, is_specialized = False, is_willpowered = False, is_damage = False, is_soak = False):
-    if ctx.message.channel.id not in BOT_CHANNELS:
-        await ctx.send("Please use roll commands in <#732660335424569456>! <a:nom:737681170682216549>")
-        return
+# Pools bigger than this are shown as a count per face instead of one emoji per die
+MAX_LISTED_DICE = 100
+MAX_POOL = 1_000_000
 
+def parse_difficulty(args):
+    '''Split the arguments after the pool into (difficulty, comment), with the difficulty defaulting to 6'''
     try:
-        diff = int(args[0])
-        remainder = " ".join(args[1:])
+        return int(args[0]), " ".join(args[1:])
     except Exception:
-        diff = 6
-        remainder = " ".join(args[:])
+        return 6, " ".join(args[:])
 
+def check_roll(pool: int, diff: int):
+    '''Return what's wrong with a roll, or None if it's fine'''
     if diff > 10 or diff < 1:
-        await ctx.send("The difficulty should be at least 1 and at most 10!")
-        return
+        return "The difficulty should be at least 1 and at most 10!"
+    if pool < 1 or pool > MAX_POOL:
+        return f"The dice pool should be at least 1 and at most {MAX_POOL:,}!"
+    return None
 
-    rolls = [random.randint(1, 10) for x in range(pool)]
-    successes = sum([roll_heuristic(roll, diff, is_specialized, is_damage or is_soak) for roll in rolls])
-    if is_willpowered:
-        if successes < 0:
-            successes = 1
+class Roll:
+    '''Rolls a pool of d10s and works out the result'''
+    def __init__(self, pool: int, diff: int, is_specialized = False, is_willpowered = False, is_damage = False, is_soak = False):
+        self.pool = pool
+        self.diff = diff
+        self.is_willpowered = is_willpowered
+        self.is_damage = is_damage
+        self.is_soak = is_soak
+        if pool <= MAX_LISTED_DICE:
+            self.rolls = [random.randint(1, 10) for x in range(pool)]
+            self.faces = dice.count_faces(self.rolls)
         else:
-            successes += 1
-    if is_damage:
-        emoji = [get_damage_dice_emoji(roll) for roll in rolls]
-    elif is_soak:
-        emoji = [get_soak_dice_emoji(roll) for roll in rolls]
-    else:
-        emoji = [get_dice_emoji(roll, diff) for roll in rolls]
-    die_or_dice = "dice" if pool > 1 else "die"
-    if is_willpowered:
-        emoji = ["<a:flex:734373583173976075>"] + emoji
-    embed_desc = " ".join(emoji)
-    embed = discord.Embed(title=remainder, colour=get_context_color(ctx), description=embed_desc)
-    author = ctx.message.author
-    embed.add_field(name="Rolls", value=str(rolls), inline=True)
-    if is_damage:
-        if successes < 0:
-            successes = 0
-        embed.add_field(name="Damage", value=successes, inline=True)
-    elif is_soak:
-        if successes < 0:
-            successes = 0
-        embed.add_field(name="Soaked", value=successes, inline=True)
-    else:
-        if successes < 0:
-            embed.add_field(name="Successes", value="Botch!", inline=True)
+            # Too many to list, so only sample how many dice landed on each face
+            self.rolls = None
+            self.faces = dice.roll_faces(pool)
+        successes = dice.count_successes(self.faces, diff, is_specialized, is_damage or is_soak)
+        if is_willpowered:
+            if successes < 0:
+                successes = 1
+            else:
+                successes += 1
+        self.successes = successes
+
+    def get_emoji(self, die):
+        if self.is_damage:
+            return get_damage_dice_emoji(die)
+        if self.is_soak:
+            return get_soak_dice_emoji(die)
+        return get_dice_emoji(die, self.diff)
+
+    def emoji(self, summarize = False) -> str:
+        '''One emoji per die, or a count per emoji if there are too many dice or summarize is set'''
+        if self.rolls is not None and not summarize:
+            emoji = [self.get_emoji(roll) for roll in self.rolls]
         else:
-            embed.add_field(name="Successes", value=successes, inline=True)
+            emoji = [dice.summarize_emoji(self.faces, self.get_emoji)]
+        if self.is_willpowered:
+            emoji = ["<a:flex:734373583173976075>"] + emoji
+        return " ".join(emoji)
+
+    def describe_rolls(self) -> str:
+        return str(self.rolls) if self.rolls is not None else dice.describe_faces(self.faces)
+
+    def result(self):
+        '''The (name, value) to show the outcome with'''
+        if self.is_damage:
+            return "Damage", max(0, self.successes)
+        if self.is_soak:
+            return "Soaked", max(0, self.successes)
+        return "Successes", "Botch!" if self.successes < 0 else self.successes
+
+    def describe(self) -> str:
+        if self.is_damage:
+            return f"Rolling {self.pool} damage"
+        if self.is_soak:
+            return f"Rolling {self.pool} soak"
+        die_or_dice = "dice" if self.pool > 1 else "die"
+        return f"Rolling {self.pool} {die_or_dice} at difficulty {self.diff}"
+
+async def handle_roll(ctx, pool: int, args, is_specialized = False, is_willpowered = False, is_damage = False, is_soak = False):
+    if ctx.message.channel.id not in BOT_CHANNELS:
+        await ctx.send("Please use roll commands in <#732660335424569456>! <a:nom:737681170682216549>")
+        return
+
+    diff, remainder = parse_difficulty(args)
+    problem = check_roll(pool, diff)
+    if problem is not None:
+        await ctx.send(problem)
+        return
+
+    roll = Roll(pool, diff, is_specialized, is_willpowered, is_damage, is_soak)
+    embed = discord.Embed(title=remainder, colour=get_context_color(ctx), description=roll.emoji())
+    author = ctx.message.author
+    embed.add_field(name="Rolls", value=roll.describe_rolls(), inline=True)
+    name, value = roll.result()
+    embed.add_field(name=name, value=value, inline=True)
     embed.set_footer(text=get_nick_or_name(ctx), icon_url=author.avatar_url)
     embed.timestamp = datetime.now(timezone.utc)
 
-    if is_damage:
-        fmtstr = f"{author.mention} Rolling {pool} damage!"
-    elif is_soak:
-        fmtstr = f"{author.mention} Rolling {pool} soak!"
-    else:
-        fmtstr = f"{author.mention} Rolling {pool} {die_or_dice} at difficulty {diff}!"
-    await ctx.send(fmtstr, embed=embed)
+    await ctx.send(f"{author.mention} {roll.describe()}!", embed=embed)
 
 @help("[dicepool] [difficulty=6] [comment...]", "Plain roll.", "Roll without any special modifiers. If difficulty is not specified, defaults to 6. The comment is optional.")
 @client.command(name='r')
@@ -234,6 +330,144 @@ async def roll_dmg(ctx, pool: int, *args):
 async def roll_soak(ctx, pool:int, *args):
     await handle_roll(ctx, int(pool), args, is_soak = True)
 
+MAX_BATCH_ROLLS = 50
+# Words that can come before a batch roll's pool, and the handle_roll option each one turns on
+BATCH_MODIFIERS = {"spec": "is_specialized", "wp": "is_willpowered", "dmg": "is_damage", "soak": "is_soak"}
+# Discord allows 25 fields, 1024 characters per field and 6000 characters in total per embed
+EMBED_MAX_FIELDS = 25
+EMBED_MAX_FIELD = 1024
+EMBED_MAX_TOTAL = 5500
+
+def parse_batch_roll(spec: str):
+    '''Turn one roll like "wp spec 5 7 Dodge" into (pool, difficulty, comment, handle_roll options)'''
+    args = spec.split()
+    options = {}
+    while args and args[0].lower() in BATCH_MODIFIERS:
+        options[BATCH_MODIFIERS[args[0].lower()]] = True
+        args = args[1:]
+    pool = int(args[0])
+    diff, comment = parse_difficulty(args[1:])
+    return pool, diff, comment, options
+
+def batch_roll_field(n: int, roll: Roll, comment: str):
+    '''The (name, value) of the embed field showing one roll of a batch'''
+    name = f"{n}. {roll.describe()}"
+    if comment:
+        name = f"{name}: {comment}"[:256]
+    result, value = roll.result()
+    outcome = f"{roll.describe_rolls()} **{result}: {value}**"
+    lines = f"{roll.emoji()}\n{outcome}"
+    if len(lines) > EMBED_MAX_FIELD:
+        lines = f"{roll.emoji(summarize=True)}\n{dice.describe_faces(roll.faces)} **{result}: {value}**"
+    return name, lines
+
+def paginate_fields(fields):
+    '''Split (name, value) fields into pages that each fit in one embed'''
+    pages = [[]]
+    size = 0
+    for name, value in fields:
+        length = len(name) + len(value)
+        if pages[-1] and (len(pages[-1]) >= EMBED_MAX_FIELDS or size + length > EMBED_MAX_TOTAL):
+            pages.append([])
+            size = 0
+        pages[-1].append((name, value))
+        size += length
+    return pages
+
+@help("[roll]; [roll]; ...", "Make many rolls at once", f"""Make up to {MAX_BATCH_ROLLS} rolls in one go, separated by semicolons or new lines, and get all the results in one message.
+
+Each roll is written like a normal roll: the dice pool, then the difficulty (defaults to 6), then an optional comment. Put 'spec', 'wp', 'dmg' or 'soak' in front to roll with specialty, with willpower, for damage or for soak, like this:
+  /batch 6 7 Claws; wp spec 5 8 Dodge; dmg 4; soak 3""")
+@client.command(name="batch")
+@handle_error
+async def batch_roll(ctx, *args):
+    if ctx.message.channel.id not in BOT_CHANNELS:
+        await ctx.send("Please use roll commands in <#732660335424569456>! <a:nom:737681170682216549>")
+        return
+    # args has lost the new lines, so take everything after "/batch" from the message itself
+    specs = ctx.message.content[len(ctx.prefix) + len(ctx.invoked_with):]
+    specs = [spec.strip() for spec in specs.replace("\n", ";").split(";") if spec.strip()]
+    if len(specs) == 0:
+        await ctx.send("Please tell me what to roll, like this: /batch 5 6; dmg 3")
+        return
+    if len(specs) > MAX_BATCH_ROLLS:
+        await ctx.send(f"I can only make {MAX_BATCH_ROLLS} rolls at once!")
+        return
+
+    # Check everything before rolling anything, so a typo doesn't leave half a round rolled
+    parsed = []
+    for n, spec in enumerate(specs, 1):
+        try:
+            pool, diff, comment, options = parse_batch_roll(spec)
+        except (IndexError, ValueError):
+            await ctx.send(f"I couldn't understand roll {n}, `{spec}`. It should start with the dice pool, like `5 6`.")
+            return
+        problem = check_roll(pool, diff)
+        if problem is not None:
+            await ctx.send(f"Roll {n}, `{spec}`: {problem}")
+            return
+        parsed.append((pool, diff, comment, options))
+
+    fields = [batch_roll_field(n, Roll(pool, diff, **options), comment)
+        for n, (pool, diff, comment, options) in enumerate(parsed, 1)]
+    pages = paginate_fields(fields)
+    author = ctx.message.author
+    for i, page in enumerate(pages, 1):
+        embed = discord.Embed(colour=get_context_color(ctx))
+        for name, value in page:
+            embed.add_field(name=name, value=value, inline=False)
+        footer = get_nick_or_name(ctx) if len(pages) == 1 else f"{get_nick_or_name(ctx)} - page {i}/{len(pages)}"
+        embed.set_footer(text=footer, icon_url=author.avatar_url)
+        embed.timestamp = datetime.now(timezone.utc)
+        content = f"{author.mention} Rolling {len(parsed)} rolls!" if i == 1 else None
+        await ctx.send(content, embed=embed)
+
+ODDS_MAX_POOL = 10_000
+# Only list numbers of successes with at least this chance of happening
+ODDS_CUTOFF = 0.001
+ODDS_MAX_ROWS = 20
+
+@help("[dicepool] [difficulty=6] spec(?) wp(?)", "Chance of success", """Work out the exact chance of each number of successes, without rolling. If difficulty is not specified, it defaults to 6.
+
+Add 'spec' to count 10s as two successes, and 'wp' to add a success from willpower, like this: /odds 5 7 spec wp""")
+@client.command(name="odds")
+@handle_error
+async def odds(ctx, *args):
+    if ctx.message.channel.id not in BOT_CHANNELS:
+        await ctx.send("Please use roll commands in <#732660335424569456>! <a:nom:737681170682216549>")
+        return
+    is_specced = "spec" in args
+    is_willpowered = "wp" in args
+    numbers = [arg for arg in args if arg not in ["spec", "wp"]]
+    try:
+        pool = int(numbers[0])
+        diff = int(numbers[1]) if len(numbers) > 1 else 6
+    except (IndexError, ValueError):
+        await ctx.send("Please tell me the dice pool, like this: /odds 5")
+        return
+    if pool < 1 or pool > ODDS_MAX_POOL:
+        await ctx.send(f"The dice pool should be at least 1 and at most {ODDS_MAX_POOL:,}!")
+        return
+    if diff > 10 or diff < 1:
+        await ctx.send("The difficulty should be at least 1 and at most 10!")
+        return
+
+    successes, botch = dice.success_odds(pool, diff, is_specced, is_willpowered)
+    lines = [f'{"Successes".rjust(9)}  {"Exactly".rjust(7)}  {"At least".rjust(8)}']
+    at_least = sum(successes.values())
+    for n in range(0, max(successes) + 1):
+        p = successes.get(n, 0.0)
+        if p >= ODDS_CUTOFF:
+            lines.append(f'{str(n).rjust(9)}  {p:7.2%}  {at_least:8.2%}')
+            if len(lines) > ODDS_MAX_ROWS:
+                break
+        at_least -= p
+    modifiers = "".join([" with specialty" if is_specced else "", " with willpower" if is_willpowered else ""])
+    die_or_dice = "dice" if pool > 1 else "die"
+    expected = sum(n * p for n, p in successes.items())
+    text = "```\n" + "\n".join(lines) + "\n```"
+    await ctx.send(f"Odds for {pool} {die_or_dice} at difficulty {diff}{modifiers}:\n{text}Botch: {botch:.2%}, average successes: {expected:.2f}")
+
 
 #
 # SCENE COMMANDS
@@ -279,14 +513,50 @@ def is_admin(member):
             return True
     return False
 
+def rp_channel_creator(guild):
+    '''Returns a function that makes rp-<number> in the roleplay category'''
+    async def create_channel(number):
+        category = guild.get_channel(ROLEPLAY_CHANNELS_CATEGORY)
+        return await guild.create_text_channel(f'rp-{number}', category=category)
+    return create_channel
+
+# Channel topic edits, coalesced per channel
+topics = TopicScheduler()
+# Last post times of scenes, written out in batches
+activity = ActivityTracker()
+
+# How often to check that every guild has enough spare rp- channels, in seconds
+SPARE_CHECK_INTERVAL = 60
+async def keep_spare_channels():
+    '''Make rp- channels ahead of time, so /scene rarely has to wait for one to be created'''
+    await client.wait_until_ready()
+    while not client.is_closed():
+        for guild in client.guilds:
+            if guild.get_channel(ROLEPLAY_CHANNELS_CATEGORY) is None:
+                continue
+            try:
+                made = await get_allocator(guild.id).top_up(rp_channel_creator(guild))
+                if made > 0:
+                    print(f'Made {made} spare rp- channel(s) in {guild.name}')
+            except Exception:
+                traceback.print_exc()
+        await asyncio.sleep(SPARE_CHECK_INTERVAL)
+
 SCENE_LOG = 733418460629172274
 ABORT_COMMANDS = ["stop", "nevermind", "nvm"]
 @help("[title]", "Start a scene.", "Start a scene. Luna will then ask some follow-up questions about the characters involved and the location.")
 @client.command(name="scene")
 @handle_error
 async def start_scene(ctx, *args):
-    def reply(m):
-        return m.channel == channel and m.author == author
+    async def reply():
+        try:
+            msg = await conversations.ask(channel.id, author.id)
+        except Superseded:
+            await ctx.send(f"{author.mention} You've started opening another scene, so I've stopped opening `{title}`.")
+            return None
+        if msg is None:
+            await ctx.send(f"{author.mention} I didn't hear back, so I've stopped opening your scene. Feel free to ask again later!")
+        return msg
 
         # Get user input stuff
     title = " ".join(args)
@@ -302,36 +572,25 @@ async def start_scene(ctx, *args):
     await ctx.send(f"I will start a scene named `{title}` for you. Which characters are in this scene?")
     
     async with ctx.typing():
-        msg = await ctx.bot.wait_for('message', check=reply)
-        if await do_stop(ctx, msg):
+        msg = await reply()
+        if msg is None or await do_stop(ctx, msg):
             return
     characters = msg.content
     await ctx.send("Okay! Where is the scene happening? Feel free to look at <#732651975061274734> for inspiration!")
     
     async with ctx.typing():
-        msg = await ctx.bot.wait_for('message', check=reply)
-        if await do_stop(ctx, msg):
+        msg = await reply()
+        if msg is None or await do_stop(ctx, msg):
             return
     location = msg.content
-    # Check the database to see if there is a free channel
-    db = get_database("scene", guild.id)
-    c = q.get_open_channel(db)
-    if c is None:
-        # Need to make the channel
-        category = guild.get_channel(ROLEPLAY_CHANNELS_CATEGORY)
-        channel_number = q.count_channels(db)
-        channel = await guild.create_text_channel(f'rp-{channel_number + 1}', category=category)
-        # Update db to keep everything in sync
-        q.add_new_channel(db, channel.id, channel.name)
-        c = channel.id
-    # Lock the channel
-    q.reserve_channel(db, c, title, author.id)
+    # Lock a free channel, making one if there aren't any
+    c = await get_allocator(guild.id).reserve(title, author.id, rp_channel_creator(guild))
     await ctx.send(f"Your scene has been opened in <#{c}>. Have fun!")
 
     # Notify channel of scene start
     channel = guild.get_channel(c)
-    # Channel editing has low rate limit, so do it async
-    asyncio.create_task(channel.edit(reason=f"Scene '{title}' started with {author.display_name}", topic=f"{title}: {characters} @ {location}"))
+    # Channel editing has low rate limit, so it's queued
+    topics.set_topic(channel, f"{title}: {characters} @ {location}", reason=f"Scene '{title}' started with {author.display_name}")
 
     scene_start = await channel.send(f"{author.mention} Scene started!", embed=get_scene_start_header(title, author, f"{characters} @ {location}"))
     # Put it in scene logs
@@ -339,6 +598,37 @@ async def start_scene(ctx, *args):
     await scenelog.send(embed=get_scene_start_header(title, author, f"{characters} @ {location}", get_message_link(scene_start)))
 
 
+SCENE_ENDED_TOPIC = "A roleplay channel. Type /scene your_scene_name in any channel to get started!"
+async def close_scene(guild, channel_id: int, reason: str):
+    '''Free a scene's channel, then post the end of scene notice and reset the topic'''
+    await get_allocator(guild.id).release(channel_id)
+    channel = guild.get_channel(channel_id)
+    if channel is None:
+        return
+    await channel.send(embed=discord.Embed(description="End scene."))
+    # Finally, reset the channel message.
+    topics.set_topic(channel, SCENE_ENDED_TOPIC, reason=reason)
+
+# How often to look for scenes nobody has posted in lately, in seconds
+IDLE_SWEEP_INTERVAL = 3600
+async def end_idle_scenes():
+    '''End scenes that have had no posts for IDLE_SCENE_DAYS, so their channels can be reused'''
+    if IDLE_SCENE_DAYS <= 0:
+        return
+    await client.wait_until_ready()
+    while not client.is_closed():
+        # Make sure recent posts are in the database before judging what's idle
+        await activity.flush()
+        cutoff = datetime.utcnow() - timedelta(days=IDLE_SCENE_DAYS)
+        for guild in client.guilds:
+            try:
+                for channel_id in await aq.list_idle_scenes(get_database("scene", guild.id), cutoff):
+                    await close_scene(guild, channel_id, reason=f"Scene ended after {IDLE_SCENE_DAYS:g} days without posts")
+                    print(f'Ended idle scene in {channel_id} in {guild.name}')
+            except Exception:
+                traceback.print_exc()
+        await asyncio.sleep(IDLE_SWEEP_INTERVAL)
+
 @help("", "End the scene.", "Ends the scene in the channel that this command is called. Only the user who opened the scene can close it, or a moderator.")
 @client.command(name = "end")
 @handle_error
@@ -347,24 +637,21 @@ async def end_scene(ctx, *args):
     await ctx.message.delete()
 
     db = get_database("scene", ctx.message.guild.id)
-    info = q.get_channel_info(db, ctx.message.channel.id)
+    info = await aq.get_channel_info(db, ctx.message.channel.id)
     # It has to be a channel that is an RP channel & in use
     if info is None or info.is_available:
         return
     author = ctx.message.author
     # Next, check that the author is either the same as the person who made the scene, or is a staff
     if info.created_by == author.id or is_staff(author):
-        q.free_channel(db, ctx.message.channel.id)
-        await ctx.send(embed=discord.Embed(description="End scene."))
-        # Finally, reset the channel message.
-        await ctx.message.channel.edit(reason=f"Scene ended by {author.display_name}", topic="A roleplay channel. Type /scene your_scene_name in any channel to get started!")
+        await close_scene(ctx.message.guild, ctx.message.channel.id, reason=f"Scene ended by {author.display_name}")
 
 @help("", "List RP channels", "Lists all the RP channels that exist, as well as whether they are open")
 @client.command(name = "listrp")
 @handle_error
 async def list_scenes(ctx):
     db = get_database("scene", ctx.message.guild.id)
-    info = q.list_channels(db)
+    info = await aq.list_channels(db)
     output = []
     for name, scene_name in info:
         name = "#" + name[:7]
@@ -389,30 +676,43 @@ def get_period_human(before=None, after=None):
     return f"between {after.strftime(HUMAN_DATE_FORMAT)} and {before.strftime(HUMAN_DATE_FORMAT)}"
 
 # Fetch leaderboard info & formats it into a Message-ready format
-def into_leaderboard(ctx, before=None, after=None, limit=None):
-    board = q.count_messages(get_database("leaderboard", ctx.guild.id), before=before, after=after, limit=limit)
+async def into_leaderboard(ctx, before=None, after=None, limit=None):
+    # Make sure buffered messages are counted. Writing them also drops the cache.
+    await recorder.flush(ctx.guild.id)
+    # Hold on to this guild's cache, so if it's invalidated while we count, our result is thrown away with it
+    cache = leaderboard_cache.setdefault(ctx.guild.id, LRUCache(LEADERBOARD_CACHE_SIZE))
+    key = (before, after, limit)
+    text = cache.get(key)
+    if text is not None:
+        return text
+    board = await aq.count_messages(get_database("leaderboard", ctx.guild.id), before=before, after=after, limit=limit)
     board = [(ctx.guild.get_member(author_id).display_name, count) for author_id, count in board]
     board = [f'    {"Name".center(16, "-")}  Posts'] +  [f'{str(i).rjust(2)}. {t[0][:16].rjust(16)}     {str(t[1]).rjust(2)}' for i, t in enumerate(board, 1)]
-    return "```" + "\n".join(board) + "```"
+    text = "```" + "\n".join(board) + "```"
+    cache.put(key, text)
+    return text
+
+def get_start_of_week(now):
+    '''Midnight at the start of the most recent Sunday'''
+    start = now - timedelta(days=(now.weekday() + 1) % 7)
+    return start.replace(hour=0, minute=0, second=0, microsecond=0)
 
 @help("", "Shows the week leaderboard.", "Shows the leaderboard for the current week, from Sunday to the current day.")
 @client.command(name="weekly")
 @handle_error
 async def show_leaderboard_weekly(ctx):
     '''Show the leaderboard for this week'''
-    now = datetime.now(timezone.utc)
-    start_of_week = now - timedelta(days=(now.weekday() + 1) % 7, hours=now.hour, minutes=now.minute)
-    await ctx.send("Here's the leaderboard for this week!\n" + into_leaderboard(ctx, after=start_of_week, limit=10))
+    start_of_week = get_start_of_week(datetime.now(timezone.utc))
+    await ctx.send("Here's the leaderboard for this week!\n" + await into_leaderboard(ctx, after=start_of_week, limit=10))
 
 @help("", "Show last week's leaderboard", "Shows the leaderboard for last week.")
 @client.command(name="lastweek")
 @handle_error
 async def show_leaderboard_lastweek(ctx):
     '''Show the leaderboard for last week.'''
-    now = datetime.now(timezone.utc)
-    start_of_last_week = now - timedelta(days=((now.weekday() + 1) % 7 + 7), hours=now.hour, minutes=now.minute)
-    start_of_week = now - timedelta(days=(now.weekday() + 1) % 7, hours=now.hour, minutes=now.minute)
-    await ctx.send("Here's the leaderboard for last week!\n" + into_leaderboard(ctx, after=start_of_last_week, before=start_of_week))
+    start_of_week = get_start_of_week(datetime.now(timezone.utc))
+    start_of_last_week = start_of_week - timedelta(days=7)
+    await ctx.send("Here's the leaderboard for last week!\n" + await into_leaderboard(ctx, after=start_of_last_week, before=start_of_week))
 
 
 @help("", "TBA", "Not implemented yet.")
@@ -440,13 +740,134 @@ async def clear_last(ctx, x: int):
     # Do the deleet
     messages =  await ctx.message.channel.history(limit=x).flatten()
     await ctx.channel.delete_messages(messages)
-    
+
+# Backfilled messages are written this many at a time, along with the channel's checkpoint
+BACKFILL_BATCH = 1000
+# Guilds with a backfill running
+backfilling = set()
+
+async def backfill_channel(guild_id: int, channel, oldest_id):
+    '''Read a channel's history from newest to oldest, starting before oldest_id if given.
+    Returns (messages read, messages that were new, messages skipped because their day was already compacted).'''
+    before = None if oldest_id is None else discord.Object(id=oldest_id)
+    seen = 0
+    new = 0
+    skipped = 0
+    rows = []
+    async for msg in channel.history(limit=None, before=before):
+        rows.append(q.message_row(msg))
+        if len(rows) >= BACKFILL_BATCH:
+            # Fetched each time, so the pool sees it in use and doesn't close it during a long walk
+            batch_new, batch_skipped = await aq.save_backfill(get_database("leaderboard", guild_id), channel.id, rows, rows[-1][3], False)
+            new += batch_new
+            skipped += batch_skipped
+            seen += len(rows)
+            rows = []
+    # Reached the start of the channel
+    oldest_id = rows[-1][3] if rows else oldest_id
+    batch_new, batch_skipped = await aq.save_backfill(get_database("leaderboard", guild_id), channel.id, rows, oldest_id, True)
+    new += batch_new
+    skipped += batch_skipped
+    seen += len(rows)
+    return seen, new, skipped
+
+@help("fresh(?)", "Backfill the leaderboard", "Count old messages in the roleplay channels, including ones sent while Luna was offline. Picks up where the last backfill stopped, unless 'fresh' is given. Only usable by admins.")
+@client.command(name="backfill")
+@handle_error
+async def backfill(ctx, *args):
+    if not is_admin(ctx.message.author):
+        await ctx.send(f"I'm sorry, {ctx.message.author.display_name}, I'm afraid I can't do that. (Only admins can!)")
+        return
+    guild = ctx.guild
+    if guild.id in backfilling:
+        await ctx.send("I'm already backfilling this server!")
+        return
+    backfilling.add(guild.id)
+    try:
+        if "fresh" in args:
+            await aq.clear_backfill_progress(get_database("leaderboard", guild.id))
+        progress = await aq.get_backfill_progress(get_database("leaderboard", guild.id))
+        channels = [channel for channel in guild.get_channel(ROLEPLAY_CHANNELS_CATEGORY).text_channels
+            if not progress.get(channel.id, (None, False))[1]]
+        await ctx.send(f"Backfilling {len(channels)} channel(s)...")
+        start = time.monotonic()
+        total_seen = 0
+        total_new = 0
+        total_skipped = 0
+        for channel in channels:
+            oldest_id = progress.get(channel.id, (None, False))[0]
+            seen, new, skipped = await backfill_channel(guild.id, channel, oldest_id)
+            total_seen += seen
+            total_new += new
+            total_skipped += skipped
+            invalidate_leaderboards(guild.id)
+        elapsed = time.monotonic() - start
+        rate = total_seen / elapsed if elapsed > 0 else 0
+        await ctx.send(f"Backfilled {total_seen} messages, {total_new} of them new, in {elapsed:.0f}s ({rate:.0f} messages/s).")
+        if total_skipped > 0:
+            await ctx.send(f"{total_skipped} of them were from days already compacted into daily totals, so they were skipped to avoid counting them twice.")
+    finally:
+        backfilling.discard(guild.id)
+
 
 
 #
 #  Misc administration
 #
 
+metrics.STATS["db_pool"] = POOL.stats
+metrics.STATS["topic_edits"] = topics.stats
+metrics.STATS["retention"] = compactor.stats
+metrics.STATS["conversations"] = conversations.stats
+metrics.STATS["scene_activity"] = activity.stats
+
+# Functions from these files are listed in the /profile summary
+PROFILED_FILES = {"main.py", "queries.py", "aqueries.py", "db.py", "recorder.py", "retention.py", "scenes.py", "dice.py", "edits.py", "conversations.py"}
+MAX_PROFILE_SECONDS = 300
+profiling = False
+
+@help("[seconds=30]", "Profile the bot", "Samples what the bot is doing for a number of seconds, then uploads a flamegraph-ready file of collapsed stacks. Only usable by admins.")
+@client.command(name="profile")
+@handle_error
+async def profile(ctx, *args):
+    global profiling
+    if not is_admin(ctx.message.author):
+        await ctx.send(f"I'm sorry, {ctx.message.author.display_name}, I'm afraid I can't do that. (Only admins can!)")
+        return
+    seconds = int(args[0]) if args else 30
+    if seconds < 1 or seconds > MAX_PROFILE_SECONDS:
+        await ctx.send(f"I can only profile for between 1 and {MAX_PROFILE_SECONDS} seconds.")
+        return
+    if profiling:
+        await ctx.send("I'm already being profiled!")
+        return
+    profiling = True
+    try:
+        await ctx.send(f"Profiling for {seconds} seconds...")
+        sampler = SamplingProfiler()
+        sampler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            sampler.stop()
+    finally:
+        profiling = False
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"profile-{datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S')}.collapsed")
+    sampler.write_collapsed(path)
+    hottest = "\n".join(f'{str(count).rjust(6)}  {label}' for label, count in sampler.hottest(PROFILED_FILES))
+    await ctx.send(f"Took {sampler.samples} samples. Busiest functions:\n```\n{hottest or 'Nothing, I was idle!'}\n```",
+        file=discord.File(path))
+
+@help("", "Show bot statistics", "Shows how long commands, events and database queries have been taking, and how far behind the bot is. Only usable by staff.")
+@client.command(name="stats")
+@handle_error
+async def stats(ctx):
+    if not is_staff(ctx.message.author):
+        await ctx.send("Only staff can see my stats. :bar_chart:")
+        return
+    await ctx.send(f"```\n{metrics.summary()[:1990]}\n```")
+
 def parse_member(ctx, s: str):
     import re
     '''Interpret the string as a member, either searching by id or extracting an ID from a mention. Return None if not possible'''
@@ -465,7 +886,56 @@ def parse_member(ctx, s: str):
         return ctx.guild.get_member(id)
     return None
 
-@help("[user id/mention] [clan]", "Embrace", "Give the Embraced role to a user, removing Torpid if applicable. Only usable by staff.")
+def parse_members(ctx, identifiers):
+    '''parse_member for each identifier, returning (members without duplicates, identifiers that matched nobody)'''
+    members = {}
+    missing = []
+    for identifier in identifiers:
+        member = parse_member(ctx, identifier)
+        if member is None:
+            missing.append(identifier)
+        else:
+            members[member.id] = member
+    return list(members.values()), missing
+
+# Most people embrace or torpor can take at once
+MAX_ROLE_TARGETS = 50
+# Role edits in flight at once. discord.py already waits out rate limits, this keeps a big batch from piling into them.
+ROLE_EDIT_CONCURRENCY = 4
+
+async def change_roles(members, add, remove, reason: str):
+    '''Give each member the add roles and take away the remove roles, with one edit per member.
+    Returns a list of (member, None if it worked or what went wrong).'''
+    semaphore = asyncio.Semaphore(ROLE_EDIT_CONCURRENCY)
+    remove_ids = {role.id for role in remove if role is not None}
+    add = [role for role in add if role is not None]
+    async def change(member):
+        # @everyone can't be set, so it's left out of both
+        current = [role for role in member.roles if not role.is_default()]
+        roles = [role for role in current if role.id not in remove_ids]
+        roles += [role for role in add if role not in roles]
+        if set(roles) == set(current):
+            return None
+        async with semaphore:
+            try:
+                await member.edit(roles=roles, reason=reason)
+            except discord.Forbidden:
+                return "I'm not allowed to change their roles"
+            except discord.HTTPException as e:
+                return f"Discord wouldn't let me ({e.status})"
+        return None
+    return list(zip(members, await asyncio.gather(*[change(member) for member in members])))
+
+def describe_role_changes(done: str, results, missing) -> str:
+    '''One reply for a batch of role changes, where done is what to say about the ones that worked'''
+    lines = [] if all(error is not None for member, error in results) else [done]
+    lines += [f"I couldn't change {member.mention}: {error}" for member, error in results if error is not None]
+    if missing:
+        lines.append(f"I couldn't find {', '.join(missing)} :sob:")
+    text = "\n".join(lines)
+    return text if len(text) <= 2000 else text[:1997] + "..."
+
+@help("[user ids/mentions...] [clan]", "Embrace", "Give the Embraced role and a clan to one or more users, removing Torpid if applicable. Only usable by staff.")
 @client.command(name = "embrace")
 @handle_error
 async def embrace(ctx, *args):
@@ -475,24 +945,28 @@ async def embrace(ctx, *args):
     elif len(args) < 2:
         await ctx.send("Please specify which clan to embrace them into!")
         return
-    identifier = args[0]
-    clan = args[1].lower()
+    identifiers = args[:-1]
+    clan = args[-1].lower()
     if not is_staff(ctx.message.author):
         await ctx.send("The gift of the Blood can only be bestowed ... by staff. :woman_vampire:")
         return
-    target = parse_member(ctx, identifier)
-    if target is None:
+    if len(identifiers) > MAX_ROLE_TARGETS:
+        await ctx.send(f"I can only embrace {MAX_ROLE_TARGETS} people at once!")
+        return
+    targets, missing = parse_members(ctx, identifiers)
+    if len(targets) == 0:
         await ctx.send("I couldn't find the person you're trying to embrace :sob:")
         return
-    await target.remove_roles(ctx.guild.get_role(ROLE_TORPID), reason=f"Embraced by {ctx.message.author.display_name}")
     clan_role = get_clan(ctx.guild, clan)
     if clan_role is None:
         await ctx.send(f"I'm not sure what clan '{clan}' is :dizzy_face:")
         return
-    await target.add_roles(ctx.guild.get_role(ROLE_EMBRACED), clan_role, reason=f"Embraced by {ctx.message.author.display_name}")
-    await ctx.send(f"Embraced {target.mention} as {clan}!")
+    results = await change_roles(targets, add=[ctx.guild.get_role(ROLE_EMBRACED), clan_role], remove=[ctx.guild.get_role(ROLE_TORPID)],
+        reason=f"Embraced by {ctx.message.author.display_name}")
+    mentions = ", ".join(member.mention for member, error in results if error is None)
+    await ctx.send(describe_role_changes(f"Embraced {mentions} as {clan}!", results, missing))
 
-@help("[user id/mention]", "Put someone into Torpor", "Put a user into Torpor, removing the Embraced roll and adding the Torpid role.")
+@help("[user ids/mentions...]", "Put someone into Torpor", "Put one or more users into Torpor, removing the Embraced roll and adding the Torpid role.")
 @client.command(name = "torpor")
 @handle_error
 async def torpor(ctx, *args):
@@ -502,13 +976,17 @@ async def torpor(ctx, *args):
     if len(args) < 1:
         await ctx.send("Please specify who you're putting into torpor! :coffin:")
         return
-    target = parse_member(ctx, args[0])
-    if target is None:
+    if len(args) > MAX_ROLE_TARGETS:
+        await ctx.send(f"I can only put {MAX_ROLE_TARGETS} people into torpor at once!")
+        return
+    targets, missing = parse_members(ctx, args)
+    if len(targets) == 0:
         await ctx.send("I couldn't find the person you're trying to torpor :sob:")
         return
-    await target.remove_roles(ctx.guild.get_role(ROLE_EMBRACED), reason=f"Torpored by {ctx.message.author.display_name}")
-    await target.add_roles(ctx.guild.get_role(ROLE_TORPID), reason=f"Torpored by {ctx.message.author.display_name}")
-    await ctx.send(f"Put {target.mention} into Torpor!")
+    results = await change_roles(targets, add=[ctx.guild.get_role(ROLE_TORPID)], remove=[ctx.guild.get_role(ROLE_EMBRACED)],
+        reason=f"Torpored by {ctx.message.author.display_name}")
+    mentions = ", ".join(member.mention for member, error in results if error is None)
+    await ctx.send(describe_role_changes(f"Put {mentions} into Torpor!", results, missing))
 
 @help("", "Make something go wrong", "Triggers the effects that normally happen when Luna suffers an error, which also includes pinging Sky. Use with caution.")
 @client.command(name = "error")
@@ -520,5 +998,24 @@ if __name__ == "__main__":
     import logging
     logging.basicConfig(level=30)
 
-    os.makedirs("databases", exist_ok=True)
-    client.run(os.getenv("DISCORD_TOKEN"))
+    os.makedirs(DATABASE_DIR, exist_ok=True)
+    # Run pending migrations for every guild now, rather than on each guild's first message
+    def migration_progress(done, total, key, result):
+        status = f"failed: {result}" if isinstance(result, Exception) else f"from version {result}"
+        print(f'Migrated {done}/{total}: {key[1]} {key[0]} {status}')
+    migrate_all(progress=migration_progress)
+    client.loop.create_task(recorder.run())
+    client.loop.create_task(POOL.run())
+    client.loop.create_task(compactor.run())
+    client.loop.create_task(keep_spare_channels())
+    client.loop.create_task(activity.run())
+    client.loop.create_task(end_idle_scenes())
+    client.loop.create_task(metrics.sample_loop_lag())
+    client.loop.create_task(metrics.write_periodically())
+    try:
+        client.run(os.getenv("DISCORD_TOKEN"))
+    finally:
+        # Don't lose whatever was still buffered
+        recorder.flush_blocking()
+        activity.flush_blocking()
+        POOL.close_all()
@@ -0,0 +1,157 @@
+# Latency histograms, counters and event loop lag, viewable with /stats and written out in Prometheus text format
+import asyncio
+import math
+import os
+import time
+from functools import wraps
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, math.inf]
+# How often to sample event loop lag and to write the metrics file, in seconds
+LAG_INTERVAL = 0.5
+WRITE_INTERVAL = 60
+METRICS_FILE = os.getenv("METRICS_FILE", "metrics.prom")
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q: float) -> float:
+        '''Estimate a quantile as the upper bound of the bucket it falls in'''
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.started = time.monotonic()
+        # (time, value) at the last rate() call, so the rate covers the time since then
+        self.last = (self.started, 0)
+
+    def inc(self, n: int = 1):
+        self.value += n
+
+    def rate(self) -> float:
+        '''Per second, since the last time this was asked for'''
+        now = time.monotonic()
+        then, value = self.last
+        self.last = (now, self.value)
+        return (self.value - value) / (now - then) if now > then else 0.0
+
+
+# name -> Histogram, for each kind of thing we time
+COMMANDS = {}
+QUERIES = {}
+EVENTS = {}
+LOOP_LAG = Histogram()
+MESSAGES_RECORDED = Counter()
+# name -> function returning a dict of numbers, for other parts of the bot to report their own stats
+STATS = {}
+
+
+def observe(histograms: dict, name: str, seconds: float):
+    if name not in histograms:
+        histograms[name] = Histogram()
+    histograms[name].observe(seconds)
+
+def timed(histograms: dict, name: str = None):
+    '''Decorator that records how long each call of an async function takes'''
+    def decorator(f):
+        label = f.__name__ if name is None else name
+        @wraps(f)
+        async def inner(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await f(*args, **kwargs)
+            finally:
+                observe(histograms, label, time.perf_counter() - start)
+        return inner
+    return decorator
+
+async def sample_loop_lag():
+    '''Measure how late the event loop wakes us up, which is how long something else blocked it'''
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(LAG_INTERVAL)
+        LOOP_LAG.observe(max(0.0, time.perf_counter() - start - LAG_INTERVAL))
+
+#
+# OUTPUT
+#
+
+def summary() -> str:
+    '''A human-readable overview for /stats'''
+    lines = []
+    for title, histograms in [("Commands", COMMANDS), ("Events", EVENTS), ("Queries", QUERIES)]:
+        if not histograms:
+            continue
+        lines.append(f'{title}:')
+        for name, h in sorted(histograms.items(), key=lambda item: -item[1].sum):
+            lines.append(f'  {name[:24].ljust(24)} n={h.count:<6} avg={h.sum / h.count * 1000:7.1f}ms '
+                f'p95<={h.quantile(0.95) * 1000:7.1f}ms max={h.max * 1000:7.1f}ms')
+    lines.append(f'Loop lag: p95<={LOOP_LAG.quantile(0.95) * 1000:.1f}ms max={LOOP_LAG.max * 1000:.1f}ms')
+    lines.append(f'Messages recorded: {MESSAGES_RECORDED.value} ({MESSAGES_RECORDED.rate():.2f}/s since last asked)')
+    for name, stats in sorted(STATS.items()):
+        values = ", ".join(f'{key}={value}' for key, value in stats().items() if value is not None)
+        lines.append(f'{name}: {values}')
+    return "\n".join(lines)
+
+def prometheus_histogram(lines: list, metric: str, label: str, histograms: dict):
+    lines.append(f'# TYPE {metric} histogram')
+    for name, h in sorted(histograms.items()):
+        labels = f'{label}="{name}",' if label else ''
+        cumulative = 0
+        for bound, count in zip(BUCKETS, h.counts):
+            cumulative += count
+            le = "+Inf" if bound == math.inf else repr(bound)
+            lines.append(f'{metric}_bucket{{{labels}le="{le}"}} {cumulative}')
+        labels = f'{{{label}="{name}"}}' if label else ''
+        lines.append(f'{metric}_sum{labels} {h.sum}')
+        lines.append(f'{metric}_count{labels} {h.count}')
+
+def prometheus() -> str:
+    '''Everything in Prometheus text exposition format'''
+    lines = []
+    prometheus_histogram(lines, "lunabot_command_seconds", "command", COMMANDS)
+    prometheus_histogram(lines, "lunabot_event_seconds", "event", EVENTS)
+    prometheus_histogram(lines, "lunabot_query_seconds", "query", QUERIES)
+    prometheus_histogram(lines, "lunabot_loop_lag_seconds", None, {"": LOOP_LAG})
+    lines.append('# TYPE lunabot_messages_recorded_total counter')
+    lines.append(f'lunabot_messages_recorded_total {MESSAGES_RECORDED.value}')
+    for name, stats in sorted(STATS.items()):
+        for key, value in stats().items():
+            if value is not None:
+                lines.append(f'# TYPE lunabot_{name}_{key} gauge')
+                lines.append(f'lunabot_{name}_{key} {value}')
+    return "\n".join(lines) + "\n"
+
+def write_prometheus(path: str = None):
+    path = METRICS_FILE if path is None else path
+    # Write then rename, so a scraper never reads half a file
+    with open(path + ".tmp", "w") as f:
+        f.write(prometheus())
+    os.replace(path + ".tmp", path)
+
+async def write_periodically(path: str = None):
+    while True:
+        await asyncio.sleep(WRITE_INTERVAL)
+        write_prometheus(path)
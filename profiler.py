@@ -0,0 +1,77 @@
+# A sampling profiler that can be switched on inside the running bot.
+# It looks at every thread's stack at a fixed interval, so it costs the same however busy the bot is,
+# and writes collapsed stacks that flamegraph.pl or speedscope can read directly.
+import os
+import re
+import sys
+import threading
+from collections import Counter
+
+# Seconds between samples
+INTERVAL = 0.005
+PROFILE_DIR = "profiles"
+# Innermost frames that mean a thread is just waiting for work, which isn't interesting
+IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("thread.py", "_worker"),
+    ("threading.py", "wait"),
+}
+
+
+def frame_label(frame) -> str:
+    return f'{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})'
+
+def thread_label(name: str) -> str:
+    # Database threads are named after their guild, so leave out the numbers to group them together
+    return re.sub(r'\d+', 'N', name)
+
+
+class SamplingProfiler:
+    def __init__(self, interval: float = INTERVAL):
+        self.interval = interval
+        # "thread;outermost frame;...;innermost frame" -> number of samples
+        self.stacks = Counter()
+        self.samples = 0
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.sample, name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def sample(self):
+        me = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(frame_label(frame))
+                    frame = frame.f_back
+                stack.append(thread_label(names.get(ident, str(ident))))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def write_collapsed(self, path: str):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+
+    def hottest(self, files, n: int = 10):
+        '''The n functions from the given files that were on the stack the most, as (label, samples)'''
+        totals = Counter()
+        for stack, count in self.stacks.items():
+            # Count each function once per stack, so recursion doesn't inflate it
+            for label in set(stack.split(";")[1:]):
+                if label[label.rindex("(") + 1:-1] in files:
+                    totals[label] += count
+        return totals.most_common(n)
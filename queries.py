@@ -1,5 +1,5 @@
 from db import Database
-from datetime import datetime
+from datetime import datetime, timezone
 from typing import Union
 
 # Some commonly-used queries
@@ -14,6 +14,10 @@ def get_open_channel(db: Database) -> Union[None, int]:
     result = c.execute("SELECT id FROM channel_scenes WHERE created IS NULL;").fetchone()
     return None if result is None else result[0]
 
+def list_free_channels(db: Database):
+    '''Return the ids of every channel with no scene going on'''
+    return [row[0] for row in db.read().execute("SELECT id FROM channel_scenes WHERE created IS NULL;").fetchall()]
+
 class ChannelInfo:
     def __init__(self, is_available: bool, created_by, created_at, updated_at):
         self.is_available = is_available
@@ -23,7 +27,7 @@ class ChannelInfo:
 
 def get_channel_info(db: Database, channel_id: int) -> Union[None, ChannelInfo]:
     '''Return the information for a given channel'''
-    c = db.get()
+    c = db.read()
     info = c.execute("SELECT created_by, created, updated FROM channel_scenes WHERE id=?", (channel_id,)).fetchone()
     if info is None:
         return None
@@ -43,7 +47,8 @@ def add_new_channel(db: Database, channel_id: int, channel_name: str):
 def reserve_channel(db: Database, channel_id: int, scene_name: str, author_id: int):
     '''Reserve a channel for a scene'''
     c = db.get()
-    c.execute("UPDATE channel_scenes SET created=datetime('now', 'utc'), scene_name=?, updated=datetime('now', 'utc'), created_by=? WHERE id=?",
+    # datetime('now') is already UTC, and it's compared with the times touch_channels writes
+    c.execute("UPDATE channel_scenes SET created=datetime('now'), scene_name=?, updated=datetime('now'), created_by=? WHERE id=?",
         (scene_name, author_id, channel_id))
     db.commit()
 
@@ -53,42 +58,203 @@ def free_channel(db: Database, channel_id: int):
     c.execute("UPDATE channel_scenes SET created=NULL, updated=NULL, scene_name=NULL, created_by=NULL WHERE id=?", (channel_id,))
     db.commit()
 
+def as_sqlite_datetime(d: datetime) -> str:
+    '''Format a datetime the way sqlite's datetime() does, which is how channel_scenes stores times. Naive datetimes are UTC.'''
+    if d.tzinfo is not None:
+        d = d.astimezone(timezone.utc)
+    return d.strftime("%Y-%m-%d %H:%M:%S")
+
+def touch_channels(db: Database, last_posts):
+    '''Record the last post time of many scenes in one transaction, from (channel id, datetime) pairs.
+    Channels that aren't in a scene, or already have a later time, are left alone.'''
+    rows = [(as_sqlite_datetime(d), channel_id, as_sqlite_datetime(d)) for channel_id, d in last_posts]
+    db.get().executemany("UPDATE channel_scenes SET updated=? WHERE id=? AND created IS NOT NULL AND updated < ?", rows)
+    db.commit()
+
+def list_idle_scenes(db: Database, before: datetime):
+    '''Return the ids of channels whose scene hasn't had a post since before'''
+    rows = db.read().execute("SELECT id FROM channel_scenes WHERE updated < ?;", (as_sqlite_datetime(before),)).fetchall()
+    return [row[0] for row in rows]
+
 def count_channels(db: Database) -> int:
     '''Count the number of channels'''
-    return db.get().execute("SELECT count(*) FROM channels;").fetchone()[0]
+    return db.read().execute("SELECT count(*) FROM channels;").fetchone()[0]
 
 def list_channels(db: Database) -> int:
     '''List the channels and their state'''
-    return db.get().execute("SELECT channel_name, scene_name FROM channel_scenes;").fetchall()
+    return db.read().execute("SELECT channel_name, scene_name FROM channel_scenes;").fetchall()
 
 #
 # LEADERBOARD
 #
 
-def date_as_sql(d: datetime):
-    return d.strftime('%Y-%m-%d %H:%M:%S')
+def as_epoch(d: datetime) -> int:
+    '''Whole seconds since the epoch, which is how message dates are stored. Naive datetimes are UTC.'''
+    if d.tzinfo is None:
+        d = d.replace(tzinfo=timezone.utc)
+    return int(d.replace(microsecond=0).timestamp())
+
+def message_row(msg):
+    '''Turn a message into a row for record_messages'''
+    # created_at is a naive UTC datetime taken from the snowflake
+    return (msg.author.id, as_epoch(msg.created_at), msg.channel.id, msg.id)
+
+def compacted_until(c) -> int:
+    '''Epoch time before which messages only exist as daily totals'''
+    day = c.execute("SELECT MAX(day) FROM daily_counts;").fetchone()[0]
+    return 0 if day is None else (day + 1) * 86400
+
+def insert_messages(c, rows):
+    '''Insert rows from message_row without committing.
+    Returns (how many were new, how many were skipped because their day was already compacted).'''
+    new = 0
+    skipped = 0
+    horizon = compacted_until(c)
+    # day -> whether it's already in daily_counts
+    compacted = {}
+    for author, date, channel_id, message_id in rows:
+        if date < horizon:
+            day = date // 86400
+            if day not in compacted:
+                compacted[day] = c.execute("SELECT 1 FROM daily_counts WHERE day=? LIMIT 1;", (day,)).fetchone() is not None
+            # A compacted day's messages are already in daily_counts, so adding them again would count them twice.
+            # Days that were never compacted are stored raw, and the compactor folds them in on its next pass.
+            if compacted[day]:
+                skipped += 1
+                continue
+        inserted = c.execute("INSERT OR IGNORE INTO messages(author, date, channel_id, message_id) VALUES(?, ?, ?, ?);",
+            (author, date, channel_id, message_id)).rowcount
+        # Only count messages we didn't already have
+        if inserted == 1:
+            c.execute("""
+                INSERT INTO message_counts(hour, author, count) VALUES(? / 3600, ?, 1)
+                ON CONFLICT(hour, author) DO UPDATE SET count = count + 1;
+                """, (date, author))
+            new += 1
+    return new, skipped
+
+def record_messages(db: Database, rows):
+    '''Add many rows from message_row to the database in one transaction'''
+    insert_messages(db.get(), rows)
+    db.commit()
 
 def record_message(db: Database, msg):
     '''Add message info to the database'''
-    db.get().execute("INSERT INTO messages(author, date, channel_id, message_id) VALUES(?, datetime('now', 'utc'), ?, ?);",
-    (msg.author.id, msg.channel.id, msg.id))
-    db.commit()
+    record_messages(db, [message_row(msg)])
 
 def count_messages(db: Database, before=None, after=None, limit: int =None):
     '''Count the number of messages per person in the given time range'''
-    clauses = []
+    # Whole hours inside the range come from message_counts, and only the
+    # partial hours at either end are counted from the raw messages.
+    # Compacted days only have daily_counts, so before the retention window it's only accurate to the day.
+    after = None if after is None else as_epoch(after)
+    before = None if before is None else as_epoch(before)
+    # [first_hour, end_hour) are the hours that fit entirely inside (after, before)
+    first_hour = None if after is None else (after + 3600) // 3600
+    end_hour = None if before is None else before // 3600
+    parts = []
     variables = []
-    if before is not None:
-        clauses.append("date < ?")
-        variables.append(date_as_sql(before))
-    if after is not None:
-        clauses.append("date > ?")
-        variables.append(date_as_sql(after))
-    clauses = " AND ".join(clauses)
-    where_clause = '' if before is None and after is None else f'WHERE {clauses}'
+    if first_hour is not None and end_hour is not None and first_hour >= end_hour:
+        # Less than an hour, so it's all raw messages
+        parts.append("SELECT author, 1 AS count FROM messages WHERE date > ? AND date < ?")
+        variables += [after, before]
+    else:
+        clauses = []
+        if first_hour is not None:
+            clauses.append("hour >= ?")
+            variables.append(first_hour)
+            # The partial hour at the start
+            parts.append("SELECT author, 1 AS count FROM messages WHERE date > ? AND date < ?")
+        if end_hour is not None:
+            clauses.append("hour < ?")
+            variables.append(end_hour)
+            # The partial hour at the end
+            parts.append("SELECT author, 1 AS count FROM messages WHERE date >= ? AND date < ?")
+        where_clause = '' if len(clauses) == 0 else 'WHERE ' + " AND ".join(clauses)
+        parts.insert(0, f"SELECT author, count FROM message_counts {where_clause}")
+        if first_hour is not None:
+            variables += [after, first_hour * 3600]
+        if end_hour is not None:
+            variables += [end_hour * 3600, before]
+        # Compacted days that start at or after `after` and end by `before`
+        clauses = []
+        if after is not None:
+            clauses.append("day >= ?")
+            variables.append((after + 86399) // 86400)
+        if before is not None:
+            clauses.append("day < ?")
+            variables.append(before // 86400)
+        where_clause = '' if len(clauses) == 0 else 'WHERE ' + " AND ".join(clauses)
+        parts.append(f"SELECT author, count FROM daily_counts {where_clause}")
+    union = " UNION ALL ".join(parts)
     limit_clause = '' if limit is None else f'LIMIT {limit}'
-    return db.get().execute(f"SELECT author, COUNT(*) FROM messages {where_clause} GROUP BY author ORDER BY COUNT(*) DESC {limit_clause};", variables).fetchall()
+    return db.read().execute(f"""
+        SELECT author, SUM(count) FROM ({union})
+        GROUP BY author HAVING SUM(count) > 0 ORDER BY SUM(count) DESC {limit_clause};
+        """, variables).fetchall()
+
+def delete_messages(db: Database, msg_ids):
+    '''Delete many messages by id in one transaction, skipping any that don't exist'''
+    msg_ids = [(msg_id,) for msg_id in set(msg_ids)]
+    c = db.get()
+    rows = [c.execute("SELECT author, date FROM messages WHERE message_id=?", msg_id).fetchone() for msg_id in msg_ids]
+    c.executemany("DELETE FROM messages WHERE message_id=?", msg_ids)
+    c.executemany("UPDATE message_counts SET count = count - 1 WHERE hour = ? / 3600 AND author=?",
+        [(row[1], row[0]) for row in rows if row is not None])
+    # Leaderboard reads use their own connections, so this has to be committed for them to see it
+    db.commit()
 
 def delete_message(db: Database, msg_id: int):
     '''Delete a message by id, if it exists'''
-    db.get().execute("DELETE FROM messages WHERE message_id=?", (msg_id,))
\ No newline at end of file
+    delete_messages(db, [msg_id])
+
+def get_backfill_progress(db: Database):
+    '''Return {channel id: (oldest message id seen, whether it's done)} for every channel /backfill has touched'''
+    rows = db.read().execute("SELECT channel_id, oldest_id, done FROM backfill_progress;").fetchall()
+    return {channel_id: (oldest_id, bool(done)) for channel_id, oldest_id, done in rows}
+
+def save_backfill(db: Database, channel_id: int, rows, oldest_id: int, done: bool):
+    '''Insert a batch of backfilled rows and move the channel's checkpoint in the same transaction.
+    Returns (how many of the rows were new, how many were skipped because their day was already compacted).'''
+    c = db.get()
+    new, skipped = insert_messages(c, rows)
+    c.execute("""
+        INSERT INTO backfill_progress(channel_id, oldest_id, done) VALUES(?, ?, ?)
+        ON CONFLICT(channel_id) DO UPDATE SET oldest_id=excluded.oldest_id, done=excluded.done;
+        """, (channel_id, oldest_id, int(done)))
+    db.commit()
+    return new, skipped
+
+def clear_backfill_progress(db: Database):
+    '''Forget every checkpoint, so the next backfill starts from the newest messages again'''
+    db.get().execute("DELETE FROM backfill_progress;")
+    db.commit()
+
+def oldest_uncompacted_day(db: Database) -> Union[None, int]:
+    '''Return the earliest day that still has raw messages or hourly counts, or None if there are none'''
+    c = db.get()
+    date = c.execute("SELECT MIN(date) FROM messages;").fetchone()[0]
+    hour = c.execute("SELECT MIN(hour) FROM message_counts;").fetchone()[0]
+    days = [d for d in (None if date is None else date // 86400, None if hour is None else hour // 24) if d is not None]
+    return min(days) if days else None
+
+def compact_day(db: Database, day: int) -> int:
+    '''Fold one day's hourly counts into daily_counts and delete its raw messages, in one transaction.
+    Returns how many messages were deleted.'''
+    c = db.get()
+    deleted = c.execute("DELETE FROM messages WHERE date >= ? AND date < ?;", (day * 86400, (day + 1) * 86400)).rowcount
+    c.execute("""
+        INSERT INTO daily_counts(day, author, count)
+            SELECT ?, author, SUM(count) FROM message_counts WHERE hour >= ? AND hour < ? GROUP BY author HAVING SUM(count) > 0
+        ON CONFLICT(day, author) DO UPDATE SET count = count + excluded.count;
+        """, (day, day * 24, (day + 1) * 24))
+    c.execute("DELETE FROM message_counts WHERE hour >= ? AND hour < ?;", (day * 24, (day + 1) * 24))
+    db.commit()
+    return deleted
+
+def vacuum_step(db: Database, pages: int) -> int:
+    '''Give up to pages free pages back to the filesystem, and return how many free pages are left'''
+    c = db.get()
+    # execute() only steps the pragma once, which frees a single page, so run it as a script instead
+    c.executescript(f"PRAGMA incremental_vacuum({int(pages)});")
+    return c.execute("PRAGMA freelist_count;").fetchone()[0]
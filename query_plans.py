@@ -0,0 +1,115 @@
+# Checks that every query in queries.py is served by an index instead of a full table scan.
+# The queries run for real against throwaway databases, with their plans recorded on the way.
+# Run it after touching MIGRATIONS or queries.py: python query_plans.py
+import sys
+import tempfile
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import db
+import queries as q
+
+# These are supposed to read every row
+FULL_SCANS_ALLOWED = {"list_channels", "count_channels", "get_backfill_progress", "clear_backfill_progress"}
+
+
+class PlanCursor:
+    '''Stands in for a cursor, recording EXPLAIN QUERY PLAN for everything before running it'''
+    def __init__(self, database: db.Database, plans: list):
+        self.database = database
+        self.plans = plans
+
+    def explain(self, sql, variables):
+        plan = self.database.conn.execute("EXPLAIN QUERY PLAN " + sql, variables).fetchall()
+        self.plans.append((sql, [row[-1] for row in plan]))
+
+    def execute(self, sql, variables=()):
+        self.explain(sql, variables)
+        return self.database.conn.execute(sql, variables)
+
+    def executescript(self, sql):
+        # Only used for pragmas, which have no plan
+        return self.database.conn.executescript(sql)
+
+    def executemany(self, sql, rows):
+        rows = list(rows)
+        if rows:
+            self.explain(sql, rows[0])
+        return self.database.conn.executemany(sql, rows)
+
+
+class PlanDatabase:
+    '''Looks enough like a Database for the functions in queries.py'''
+    def __init__(self, database: db.Database):
+        self.database = database
+        self.plans = []
+
+    def get(self):
+        return PlanCursor(self.database, self.plans)
+
+    def read(self):
+        return PlanCursor(self.database, self.plans)
+
+    def commit(self):
+        self.database.commit()
+
+
+def query_calls():
+    '''Yield (server type, function name, call) for every query in queries.py'''
+    now = datetime.utcnow()
+    msg = SimpleNamespace(id=2, author=SimpleNamespace(id=3), channel=SimpleNamespace(id=4), created_at=now)
+    yield "scene", "get_open_channel", lambda d: q.get_open_channel(d)
+    yield "scene", "list_free_channels", lambda d: q.list_free_channels(d)
+    yield "scene", "get_channel_info", lambda d: q.get_channel_info(d, 1)
+    yield "scene", "add_new_channel", lambda d: q.add_new_channel(d, 1, "rp-1")
+    yield "scene", "reserve_channel", lambda d: q.reserve_channel(d, 1, "title", 3)
+    yield "scene", "free_channel", lambda d: q.free_channel(d, 1)
+    yield "scene", "touch_channels", lambda d: q.touch_channels(d, [(1, now), (2, now)])
+    yield "scene", "list_idle_scenes", lambda d: q.list_idle_scenes(d, now - timedelta(days=7))
+    yield "scene", "count_channels", lambda d: q.count_channels(d)
+    yield "scene", "list_channels", lambda d: q.list_channels(d)
+    yield "leaderboard", "record_message", lambda d: q.record_message(d, msg)
+    yield "leaderboard", "count_messages", lambda d: q.count_messages(d, after=now - timedelta(days=7), limit=10)
+    yield "leaderboard", "count_messages", lambda d: q.count_messages(d, before=now, after=now - timedelta(days=7))
+    yield "leaderboard", "delete_message", lambda d: q.delete_message(d, 2)
+    yield "leaderboard", "delete_messages", lambda d: q.delete_messages(d, [2, 5])
+    yield "leaderboard", "get_backfill_progress", lambda d: q.get_backfill_progress(d)
+    yield "leaderboard", "save_backfill", lambda d: q.save_backfill(d, 4, [(3, 1, 4, 6)], 6, False)
+    yield "leaderboard", "clear_backfill_progress", lambda d: q.clear_backfill_progress(d)
+    yield "leaderboard", "oldest_uncompacted_day", lambda d: q.oldest_uncompacted_day(d)
+    yield "leaderboard", "compact_day", lambda d: q.compact_day(d, 0)
+    # Day 0 is compacted now, so this checks daily_counts before inserting
+    yield "leaderboard", "save_backfill", lambda d: q.save_backfill(d, 4, [(3, 1, 4, 7)], 7, True)
+    yield "leaderboard", "vacuum_step", lambda d: q.vacuum_step(d, 8)
+
+
+def find_scans():
+    '''Return a list of (function name, sql, plan detail) for every full table scan'''
+    scans = []
+    database_dir = db.DATABASE_DIR
+    with tempfile.TemporaryDirectory() as directory:
+        db.DATABASE_DIR = directory
+        databases = {server_type: db.Database(server_type, 0) for server_type in db.MIGRATIONS}
+        for server_type, name, call in query_calls():
+            plan_db = PlanDatabase(databases[server_type])
+            call(plan_db)
+            if name in FULL_SCANS_ALLOWED:
+                continue
+            for sql, details in plan_db.plans:
+                for detail in details:
+                    # "SCAN t USING (COVERING) INDEX" is fine, a bare "SCAN t" is not.
+                    # Scans of subquery results don't touch a table, so they're fine too.
+                    if detail.startswith("SCAN") and "INDEX" not in detail and "subquery" not in detail:
+                        scans.append((name, " ".join(sql.split()), detail))
+        for database in databases.values():
+            database.close(wait=True)
+    db.DATABASE_DIR = database_dir
+    return scans
+
+
+if __name__ == "__main__":
+    scans = find_scans()
+    for name, sql, detail in scans:
+        print(f"{name}: {detail}\n    {sql}")
+    if scans:
+        sys.exit(1)
+    print("All queries use indexes.")
@@ -0,0 +1,99 @@
+# Write-behind buffer for the leaderboard, so on_message doesn't commit once per post
+import asyncio
+import traceback
+from db import get_database
+import queries as q
+import aqueries as aq
+
+# Flush a guild's buffer once it holds this many changes...
+MAX_PENDING = 50
+# ...or once this many seconds have passed, whichever comes first
+MAX_DELAY = 5.0
+
+
+class MessageRecorder:
+    def __init__(self, max_pending: int = MAX_PENDING, max_delay: float = MAX_DELAY, on_write=None):
+        self.max_pending = max_pending
+        self.max_delay = max_delay
+        # Called with the guild id whenever changes are written for it
+        self.on_write = on_write
+        # guild id -> list of rows waiting to be written
+        self.pending = {}
+        # guild id -> set of message ids waiting to be deleted
+        self.deleted = {}
+        # guild id -> lock held while a batch is written, so a guild's batches are written in order
+        self.locks = {}
+
+    def size(self, guild_id: int) -> int:
+        return len(self.pending.get(guild_id, ())) + len(self.deleted.get(guild_id, ()))
+
+    async def record(self, msg):
+        '''Queue a message to be counted, flushing if the buffer is full'''
+        self.pending.setdefault(msg.guild.id, []).append(q.message_row(msg))
+        if self.size(msg.guild.id) >= self.max_pending:
+            await self.flush(msg.guild.id)
+
+    async def delete(self, guild_id: int, msg_ids):
+        '''Queue messages to be uncounted, flushing if the buffer is full'''
+        msg_ids = set(msg_ids)
+        # Messages that haven't been written yet can just be forgotten
+        rows = self.pending.get(guild_id)
+        if rows:
+            self.pending[guild_id] = [row for row in rows if row[3] not in msg_ids]
+        self.deleted.setdefault(guild_id, set()).update(msg_ids)
+        if self.size(guild_id) >= self.max_pending:
+            await self.flush(guild_id)
+
+    def _take(self, guild_id: int = None):
+        '''Remove and return everything pending as (guild id, rows, deleted ids)'''
+        guild_ids = set(self.pending) | set(self.deleted) if guild_id is None else [guild_id]
+        taken = [(guild_id, self.pending.pop(guild_id, None), self.deleted.pop(guild_id, None)) for guild_id in guild_ids]
+        return [(guild_id, rows, deleted) for guild_id, rows, deleted in taken if rows or deleted]
+
+    def _put_back(self, guild_id: int, rows, deleted):
+        '''Return changes that couldn't be written, ahead of anything queued since'''
+        if rows:
+            self.pending[guild_id] = rows + self.pending.get(guild_id, [])
+        if deleted:
+            self.deleted.setdefault(guild_id, set()).update(deleted)
+
+    async def flush(self, guild_id: int = None):
+        '''Write the pending changes for one guild, or for every guild if none is given.
+        Waits for any batch of the guild's that's already being written, so reads after this see everything.'''
+        guild_ids = list(set(self.pending) | set(self.deleted)) if guild_id is None else [guild_id]
+        for guild_id in guild_ids:
+            async with self.locks.setdefault(guild_id, asyncio.Lock()):
+                for guild_id, rows, deleted in self._take(guild_id):
+                    db = get_database("leaderboard", guild_id)
+                    try:
+                        if rows:
+                            await aq.record_messages(db, rows)
+                            rows = None
+                        if deleted:
+                            await aq.delete_messages(db, deleted)
+                    except BaseException:
+                        # Keep whatever wasn't written for the next flush, or for flush_blocking if the task was cancelled
+                        # at shutdown. A cancelled write may still finish on the database thread, but writing it again
+                        # is harmless because both queries skip messages they've already handled.
+                        self._put_back(guild_id, rows, deleted)
+                        raise
+                    if self.on_write is not None:
+                        self.on_write(guild_id)
+
+    def flush_blocking(self):
+        '''Write everything that's pending without an event loop, for use at shutdown'''
+        for guild_id, rows, deleted in self._take():
+            db = get_database("leaderboard", guild_id)
+            if rows:
+                db.call(q.record_messages, rows)
+            if deleted:
+                db.call(q.delete_messages, deleted)
+
+    async def run(self):
+        '''Periodically flush everything, so quiet guilds don't sit on old changes'''
+        while True:
+            await asyncio.sleep(self.max_delay)
+            try:
+                await self.flush()
+            except Exception:
+                traceback.print_exc()
@@ -0,0 +1,81 @@
+# Retention for the leaderboard. Raw messages older than the retention window are folded into
+# per-author daily totals and deleted, then the freed pages are given back a slice at a time.
+import asyncio
+import os
+import time
+from db import find_databases, get_database
+import aqueries as aq
+
+# Raw messages are kept for this many days. 0 keeps them forever.
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "365"))
+# Seconds between looking for anything to compact
+CHECK_INTERVAL = 3600
+# Pages freed per incremental vacuum slice
+VACUUM_PAGES = 256
+# Seconds to wait between slices, so other work on the database gets a turn
+SLICE_PAUSE = 0.2
+
+
+class Compactor:
+    def __init__(self, retention_days: int = RETENTION_DAYS, on_write=None):
+        self.retention_days = retention_days
+        # Called with the guild id whenever some of its messages were compacted
+        self.on_write = on_write
+        self.days_compacted = 0
+        self.messages_deleted = 0
+        self.vacuum_slices = 0
+
+    def cutoff_day(self) -> int:
+        '''Days before this one are compacted'''
+        return (int(time.time()) - self.retention_days * 86400) // 86400
+
+    async def compact(self, guild_id: int):
+        '''Compact one guild's leaderboard a day at a time, then vacuum it a slice at a time'''
+        cutoff = self.cutoff_day()
+        compacted = False
+        while True:
+            # Fetched each time, so the pool sees it in use and doesn't close it between slices
+            db = get_database("leaderboard", guild_id)
+            day = await aq.oldest_uncompacted_day(db)
+            if day is None or day >= cutoff:
+                break
+            self.messages_deleted += await aq.compact_day(db, day)
+            self.days_compacted += 1
+            compacted = True
+            await asyncio.sleep(SLICE_PAUSE)
+        if not compacted:
+            return
+        if self.on_write is not None:
+            self.on_write(guild_id)
+        # migrate_all switched every file to incremental auto-vacuum at startup
+        previous = None
+        while True:
+            free = await aq.vacuum_step(get_database("leaderboard", guild_id), VACUUM_PAGES)
+            self.vacuum_slices += 1
+            # No progress means the file isn't in incremental mode yet, so leave it for the next startup
+            if free == 0 or free == previous:
+                break
+            previous = free
+            await asyncio.sleep(SLICE_PAUSE)
+
+    def stats(self) -> dict:
+        return {
+            "retention_days": self.retention_days,
+            "days_compacted": self.days_compacted,
+            "messages_deleted": self.messages_deleted,
+            "vacuum_slices": self.vacuum_slices,
+        }
+
+    async def run(self):
+        '''Periodically compact every leaderboard database'''
+        if self.retention_days <= 0:
+            return
+        while True:
+            for server_type, guild_id in find_databases():
+                if server_type != "leaderboard":
+                    continue
+                try:
+                    await self.compact(guild_id)
+                except Exception as e:
+                    print(f"Couldn't compact the leaderboard for {guild_id}: {e}")
+            await asyncio.sleep(CHECK_INTERVAL)
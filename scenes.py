@@ -0,0 +1,164 @@
+# Keeps track of free rp- channels in memory, so opening a scene doesn't need to search the database
+import asyncio
+import heapq
+import math
+import os
+import time
+from collections import deque
+from db import get_database
+import queries as q
+import aqueries as aq
+
+# Always try to keep at least MIN_SPARES free channels, and never make more than MAX_SPARES ahead of time
+MIN_SPARES = 1
+MAX_SPARES = 5
+# Keep enough spares for this many seconds of scenes at the rate they were opened over DEMAND_WINDOW seconds
+SPARE_LOOKAHEAD = 2 * 3600
+DEMAND_WINDOW = 24 * 3600
+# Scenes with no posts for this many days are ended automatically. 0 leaves them open forever.
+IDLE_SCENE_DAYS = float(os.getenv("IDLE_SCENE_DAYS", "14"))
+# Seconds between writing last post times to the database
+ACTIVITY_FLUSH_INTERVAL = 60
+
+
+class ChannelAllocator:
+    '''The free rp- channels for one guild. Changes are written through to the database.'''
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        self.lock = asyncio.Lock()
+        # Free channel ids as a heap, so the oldest channels get reused first. None until loaded.
+        self.free = None
+        self.channel_count = 0
+        # The number the next rp- channel gets. Taken under the lock, so two creators never pick the same one.
+        self.next_number = 1
+        # When recent scenes were opened, oldest first
+        self.opened = deque()
+
+    def db(self):
+        return get_database("scene", self.guild_id)
+
+    async def load(self):
+        '''Read channel_scenes once, the first time it's needed. Call with the lock held.'''
+        if self.free is not None:
+            return
+        free = await aq.list_free_channels(self.db())
+        heapq.heapify(free)
+        self.channel_count = await aq.count_channels(self.db())
+        self.next_number = self.channel_count + 1
+        self.free = free
+
+    async def reserve(self, scene_name: str, author_id: int, create_channel):
+        '''Reserve a free channel for a scene and return its id.
+        If none are free, await create_channel(number) to make rp-<number> and use that.'''
+        async with self.lock:
+            await self.load()
+            self.opened.append(time.monotonic())
+            if self.free:
+                channel_id = heapq.heappop(self.free)
+            else:
+                channel_id = await self.create(create_channel, self.take_number())
+            await aq.reserve_channel(self.db(), channel_id, scene_name, author_id)
+            return channel_id
+
+    def take_number(self) -> int:
+        '''Pick the number for a new rp- channel. Call with the lock held.'''
+        number = self.next_number
+        self.next_number += 1
+        return number
+
+    async def make(self, create_channel, number: int):
+        '''Await create_channel(number), giving the number back if it fails and nobody has taken a later one since'''
+        try:
+            return await create_channel(number)
+        except Exception:
+            if self.next_number == number + 1:
+                self.next_number = number
+            raise
+
+    async def create(self, create_channel, number: int) -> int:
+        '''Make rp-<number> and register it. Call with the lock held.'''
+        channel = await self.make(create_channel, number)
+        await self.register(channel)
+        return channel.id
+
+    async def register(self, channel):
+        '''Record a newly made channel. Call with the lock held.'''
+        await aq.add_new_channel(self.db(), channel.id, channel.name)
+        self.channel_count += 1
+
+    def wanted_spares(self) -> int:
+        '''How many free channels to keep around, based on how often scenes were opened lately'''
+        cutoff = time.monotonic() - DEMAND_WINDOW
+        while self.opened and self.opened[0] < cutoff:
+            self.opened.popleft()
+        expected = math.ceil(len(self.opened) * SPARE_LOOKAHEAD / DEMAND_WINDOW)
+        return max(MIN_SPARES, min(MAX_SPARES, expected))
+
+    async def top_up(self, create_channel) -> int:
+        '''Create channels ahead of time until there are enough spares, and return how many were made'''
+        made = 0
+        while True:
+            async with self.lock:
+                await self.load()
+                if len(self.free) >= self.wanted_spares():
+                    return made
+                number = self.take_number()
+            # Creating the channel is the slowest call, so it's done without the lock and a /scene can take a free channel meanwhile
+            channel = await self.make(create_channel, number)
+            async with self.lock:
+                await self.register(channel)
+                heapq.heappush(self.free, channel.id)
+            made += 1
+
+    async def release(self, channel_id: int):
+        '''Free a channel so the next scene can use it'''
+        async with self.lock:
+            await self.load()
+            await aq.free_channel(self.db(), channel_id)
+            if channel_id not in self.free:
+                heapq.heappush(self.free, channel_id)
+
+
+class ActivityTracker:
+    '''Remembers when each scene was last posted in, and writes it to channel_scenes in batches'''
+    def __init__(self, interval: float = ACTIVITY_FLUSH_INTERVAL):
+        self.interval = interval
+        # guild id -> {channel id: time of the latest post}
+        self.pending = {}
+        self.flushes = 0
+
+    def touch(self, msg):
+        self.pending.setdefault(msg.guild.id, {})[msg.channel.id] = msg.created_at
+
+    def _take(self):
+        pending = self.pending
+        self.pending = {}
+        return pending.items()
+
+    async def flush(self):
+        for guild_id, last_posts in self._take():
+            await aq.touch_channels(get_database("scene", guild_id), list(last_posts.items()))
+            self.flushes += 1
+
+    def flush_blocking(self):
+        '''Write everything that's pending without an event loop, for use at shutdown'''
+        for guild_id, last_posts in self._take():
+            get_database("scene", guild_id).call(q.touch_channels, list(last_posts.items()))
+
+    def stats(self) -> dict:
+        return {
+            "pending": sum(len(last_posts) for last_posts in self.pending.values()),
+            "flushes": self.flushes,
+        }
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+
+ALLOCATORS = {}
+def get_allocator(guild_id: int) -> ChannelAllocator:
+    if guild_id not in ALLOCATORS:
+        ALLOCATORS[guild_id] = ChannelAllocator(guild_id)
+    return ALLOCATORS[guild_id]